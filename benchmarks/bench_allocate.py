@@ -0,0 +1,242 @@
+"""
+Allocation throughput and latency, layer by layer.
+
+Seeds products with batches, then allocates order lines through
+Product.allocate, services.allocate on SQLite, and optionally
+services.allocate on Postgres and the HTTP API, with concurrent clients.
+Each scenario runs --repeat times and the report holds the median p50/p99
+latency and ops/sec. Given a baseline (a saved report made with the same
+settings), also lists the scenarios that regressed and exits 1 if there
+are any. Scenarios whose runs took under MIN_GATED_SECONDS in the baseline
+are too short to time reliably and are not compared.
+
+    python benchmarks/bench_allocate.py [--products 10] [--batches 20]
+        [--lines 2000] [--clients 4] [--repeat 3] [--postgres] [--api]
+        [--output report.json] [--baseline benchmarks/baseline.json]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from app import config
+from app.adapters import orm, unit_of_work
+from app.domain.model import Batch, OrderLine, Product
+from app.service_layer import services
+
+MIN_GATED_SECONDS = 1.0
+# One pass over the lines takes Product.allocate a few milliseconds, so the
+# domain scenario allocates wave after wave until this long has passed.
+DOMAIN_SECONDS = 2 * MIN_GATED_SECONDS
+
+
+def skus_for(args):
+    prefix = f"bench-{uuid.uuid4().hex[:6]}"
+    return [f"{prefix}-{i}" for i in range(args.products)]
+
+
+def batches_for(args, sku):
+    per_batch = -(-args.lines // (args.products * args.batches)) + 1
+    for i in range(args.batches):
+        # A third of the stock is in the warehouse, the rest on its way.
+        eta = None if i % 3 == 0 else date.today() + timedelta(days=i)
+        yield f"{sku}-batch{i}", per_batch, eta
+
+
+def lines_for(args, skus):
+    return [(f"order-{i}", skus[i % len(skus)], 1) for i in range(args.lines)]
+
+
+def summarise(latencies, wall_seconds, clients):
+    latencies = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "clients": clients,
+        "ops_per_sec": round(len(latencies) / wall_seconds, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 4),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 4),
+        "seconds": round(wall_seconds, 3),
+    }
+
+
+def repeated(bench, args):
+    """bench(args) run args.repeat times, with the median of each measure."""
+    runs = [bench(args) for _ in range(args.repeat)]
+    result = dict(runs[0], runs=len(runs))
+    for measure in ("ops_per_sec", "p50_ms", "p99_ms", "seconds"):
+        result[measure] = statistics.median(run[measure] for run in runs)
+    return result
+
+
+def run_clients(allocate, lines, clients):
+    """Call allocate(orderid, sku, qty) for every line from `clients` threads."""
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(line):
+        start = time.perf_counter()
+        allocate(*line)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(timed, lines))
+    return summarise(latencies, time.perf_counter() - start, clients)
+
+
+def bench_domain(args):
+    latencies, seconds = [], 0.0
+    while seconds < DOMAIN_SECONDS:
+        # Each wave starts from freshly seeded products; seeding is not timed.
+        skus = skus_for(args)
+        products = {}
+        for sku in skus:
+            products[sku] = Product(sku, batches=[])
+            for ref, qty, eta in batches_for(args, sku):
+                products[sku].add_batch(Batch(ref, sku, qty, eta))
+        lines = [OrderLine(*line) for line in lines_for(args, skus)]
+        start = time.perf_counter()
+        for line in lines:
+            line_start = time.perf_counter()
+            products[line.sku].allocate(line)
+            latencies.append(time.perf_counter() - line_start)
+        seconds += time.perf_counter() - start
+    return summarise(latencies, seconds, clients=1)
+
+
+def bench_services(args, engine, clients):
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    try:
+        session_factory = sessionmaker(bind=engine)
+        uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        skus = skus_for(args)
+        for sku in skus:
+            for ref, qty, eta in batches_for(args, sku):
+                services.add_batch(ref, sku, qty, eta, uow=uow())
+        allocate = lambda orderid, sku, qty: services.allocate(
+            orderid, sku, qty, uow=uow()
+        )
+        return run_clients(allocate, lines_for(args, skus), clients)
+    finally:
+        clear_mappers()
+
+
+def bench_sqlite(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.sqlite'}")
+        # SQLite has one writer at a time, so more clients only add lock waits.
+        return bench_services(args, engine, clients=1)
+
+
+def bench_postgres(args):
+    engine = create_engine(config.get_postgres_uri(), **config.get_engine_options())
+    return bench_services(args, engine, clients=args.clients)
+
+
+def bench_api(args):
+    import requests
+
+    url = config.get_api_url()
+    session = requests.Session()
+    skus = skus_for(args)
+    for sku in skus:
+        for ref, qty, eta in batches_for(args, sku):
+            eta = eta.isoformat() if eta else None
+            json_ = {"batchref": ref, "sku": sku, "qty": qty, "eta": eta}
+            session.post(f"{url}/batch", json=json_).raise_for_status()
+
+    def allocate(orderid, sku, qty):
+        json_ = {"orderid": orderid, "sku": sku, "qty": qty}
+        requests.post(f"{url}/allocation", json=json_).raise_for_status()
+
+    return run_clients(allocate, lines_for(args, skus), args.clients)
+
+
+def regressions(report, baseline, tolerance):
+    """
+    Scenarios in both reports whose p50 rose or throughput fell by more than
+    tolerance, leaving out those too short in the baseline to compare.
+    """
+    found = []
+    for name, result in report["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None or base.get("seconds", 0) < MIN_GATED_SECONDS:
+            continue
+        if result["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            found.append(f"{name}: p50 {base['p50_ms']}ms -> {result['p50_ms']}ms")
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            found.append(
+                f"{name}: {base['ops_per_sec']} -> {result['ops_per_sec']} ops/sec"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=10)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--postgres", action="store_true")
+    parser.add_argument("--api", action="store_true")
+    parser.add_argument("--output", type=Path, help="Also write the report here.")
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed fractional slowdown against the baseline.",
+    )
+    args = parser.parse_args()
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+
+    scenarios = {"domain": bench_domain, "services_sqlite": bench_sqlite}
+    if args.postgres:
+        scenarios["services_postgres"] = bench_postgres
+    if args.api:
+        scenarios["api"] = bench_api
+    settings = {"products": args.products, "batches": args.batches, "lines": args.lines}
+    if baseline is not None and baseline["settings"] != settings:
+        parser.error(
+            f"baseline was recorded with {baseline['settings']}, not {settings};"
+            " rerun with its settings or record a new baseline"
+        )
+    report = {
+        "settings": settings,
+        "scenarios": {name: repeated(bench, args) for name, bench in scenarios.items()},
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    if baseline is not None:
+        for name, base in baseline["scenarios"].items():
+            if (
+                name in report["scenarios"]
+                and base.get("seconds", 0) < MIN_GATED_SECONDS
+            ):
+                print(f"not compared, too short to time: {name}", file=sys.stderr)
+        found = regressions(report, baseline, args.tolerance)
+        for regression in found:
+            print(f"regression: {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Deallocation on a product with many allocated lines.
+
+Compares Product.deallocate, which looks orders up in an orderid index,
+with the scan it replaced: build the set of orderids for every batch, then
+search the batch's lines for the order.
+
+    python benchmarks/bench_deallocate.py [--lines 50000] [--batches 200]
+"""
+
+import argparse
+import time
+from datetime import date, timedelta
+
+from app.domain.model import Batch, OrderLine, Product
+
+
+def make_product(n_batches, n_lines):
+    sku = "BENCH-SKU"
+    per_batch = -(-n_lines // n_batches)
+    product = Product(sku, batches=[])
+    for i in range(n_batches):
+        eta = date.today() + timedelta(days=i)
+        product.add_batch(Batch(f"batch-{i}", sku, per_batch, eta=eta))
+    for i in range(n_lines):
+        product.allocate(OrderLine(f"order-{i}", sku, 1))
+    return product
+
+
+def scan_deallocate(product, orderid, sku):
+    batch = next(
+        (
+            b
+            for b in product.batches
+            if orderid in {a.orderid for a in b._allocations} and b.sku == sku
+        ),
+        None,
+    )
+    if batch is not None:
+        for line in batch._allocations:
+            if line.orderid == orderid:
+                batch._allocations.remove(line)
+                batch.invalidate_allocation_cache()
+                return
+
+
+def time_deallocations(deallocate, product, orderids):
+    start = time.perf_counter()
+    for orderid in orderids:
+        deallocate(product, orderid, product.sku)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, default=50_000)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--deallocations", type=int, default=200)
+    args = parser.parse_args()
+
+    step = max(args.lines // args.deallocations, 1)
+    orderids = [f"order-{i}" for i in range(0, args.lines, step)]
+    results = {
+        "scan": time_deallocations(
+            scan_deallocate, make_product(args.batches, args.lines), orderids
+        ),
+        "indexed": time_deallocations(
+            Product.deallocate, make_product(args.batches, args.lines), orderids
+        ),
+    }
+
+    print(f"{len(orderids)} deallocations, {args.lines} lines, {args.batches} batches")
+    for name, seconds in results.items():
+        per_op = seconds / len(orderids) * 1e6
+        print(f"  {name:>8}: {seconds:8.4f}s total  {per_op:10.1f}us/op")
+    print(f"  speedup: {results['scan'] / results['indexed']:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
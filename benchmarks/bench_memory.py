@@ -0,0 +1,97 @@
+"""
+Memory held per allocated order line.
+
+Builds a product with many allocated lines, in memory and loaded back from
+SQLite through the repository, and reports the bytes traced per line,
+with and without the orderid indexes built (deallocation builds them).
+
+    python benchmarks/bench_memory.py [--lines 100000] [--batches 100]
+"""
+
+import argparse
+import gc
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from app.adapters import orm
+from app.adapters.product_repository import SqlAlchemyProductRepository
+from app.domain.model import Batch, OrderLine, Product
+
+SKU = "BENCH-SKU"
+
+
+def build_product(n_batches, n_lines):
+    per_batch = -(-n_lines // n_batches)
+    product = Product(SKU, batches=[])
+    for i in range(n_batches):
+        product.add_batch(Batch(f"batch-{i}", SKU, per_batch))
+    for i in range(n_lines):
+        # Lines usually arrive with their own copy of the sku, as from JSON.
+        product.allocate(OrderLine(f"order-{i}", "".join(SKU), 1))
+    return product
+
+
+def traced(build):
+    """(object, bytes allocated by build() that are still held)."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def index_bytes(product):
+    """Bytes held by the product's and its batches' orderid indexes."""
+    _, size = traced(product._orderid_index)
+    return size
+
+
+def measure_in_memory(args):
+    product, size = traced(lambda: build_product(args.batches, args.lines))
+    return size, index_bytes(product)
+
+
+def measure_loaded(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.sqlite'}")
+        orm.metadata.create_all(engine)
+        orm.start_mappers()
+        try:
+            session_factory = sessionmaker(bind=engine)
+            session = session_factory()
+            session.add(build_product(args.batches, args.lines))
+            session.commit()
+            session.close()
+            session = session_factory()
+            repository = SqlAlchemyProductRepository(session, loading="selectin")
+            product, size = traced(lambda: repository.get(SKU))
+            return size, index_bytes(product)
+        finally:
+            clear_mappers()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument("--batches", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{args.lines} lines over {args.batches} batches, bytes per line:")
+    for name, measure in [("in memory", measure_in_memory), ("loaded", measure_loaded)]:
+        size, indexes = measure(args)
+        print(
+            f"  {name:>9}: {size / args.lines:6.0f}"
+            f"  + orderid indexes {indexes / args.lines:5.0f}"
+            f"  = {(size + indexes) / args.lines:6.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
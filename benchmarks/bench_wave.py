@@ -0,0 +1,62 @@
+"""
+Allocating a wave of order lines for one product at once.
+
+Times Product.allocate_many against calling Product.allocate for each line
+of the same wave, on identical products, and checks both give the same
+assignments.
+
+    python benchmarks/bench_wave.py [--lines 10000] [--batches 200]
+"""
+
+import argparse
+import time
+from datetime import date, timedelta
+
+from app.domain.model import Batch, OrderLine, OutOfStock, Product
+
+SKU = "BENCH-SKU"
+
+
+def build_product(args):
+    product = Product(SKU, batches=[])
+    # Enough stock for about nine lines in ten.
+    per_batch = -(-args.lines * 9 // (args.batches * 10))
+    for i in range(args.batches):
+        eta = None if i % 3 == 0 else date.today() + timedelta(days=i)
+        product.add_batch(Batch(f"batch-{i}", SKU, per_batch, eta))
+    return product
+
+
+def allocate_each(product, wave):
+    results = []
+    for line in wave:
+        try:
+            results.append(product.allocate(line))
+        except OutOfStock:
+            results.append(None)
+    return results
+
+
+def allocate_wave(product, wave):
+    return [r if isinstance(r, str) else None for r in product.allocate_many(wave)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, default=10_000)
+    parser.add_argument("--batches", type=int, default=200)
+    args = parser.parse_args()
+
+    wave = [OrderLine(f"order-{i}", SKU, i % 3 + 1) for i in range(args.lines)]
+    results = {}
+    print(f"{args.lines} lines over {args.batches} batches:")
+    for name, allocate in [("each", allocate_each), ("wave", allocate_wave)]:
+        product = build_product(args)
+        start = time.perf_counter()
+        results[name] = allocate(product, wave)
+        print(f"  {name:>4}: {(time.perf_counter() - start) * 1000:8.2f} ms")
+    assert results["each"] == results["wave"], "wave allocation differs"
+
+
+if __name__ == "__main__":
+    main()
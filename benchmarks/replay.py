@@ -0,0 +1,229 @@
+"""
+Replay recorded requests against the service layer or the HTTP API.
+
+Reads JSONL captures, one request per line:
+
+    {"ts": 1700000000.25, "method": "POST", "path": "/allocation",
+     "body": {"orderid": "o1", "sku": "RED-CHAIR", "qty": 3}}
+
+`ts` (seconds) is optional and sets the traffic shape: requests go out at
+their recorded offsets divided by --speed, or as fast as the clients allow
+with --speed 0. Records that aren't requests for a route we know are
+counted and skipped. Prints a JSON report with a latency histogram and the
+errors by kind. Latency runs from when each request was due to go out, so
+it includes any wait for a free client.
+
+    python benchmarks/replay.py capture.jsonl [--target services|http]
+        [--database URL] [--clients 8] [--speed 1] [--rate 0]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import config
+from app.adapters import orm, unit_of_work
+from app.service_layer import services
+
+ROUTES = {
+    ("POST", "/allocation"),
+    ("POST", "/allocations"),
+    ("DELETE", "/allocation"),
+    ("POST", "/batch"),
+}
+
+# Upper bounds, in milliseconds, of the latency histogram's buckets.
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def read_requests(lines, skipped: Counter):
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            skipped["invalid_json"] += 1
+            continue
+        if not isinstance(record, dict):
+            skipped["unrecognised"] += 1
+            continue
+        method = str(record.get("method", "")).upper()
+        if (method, record.get("path")) not in ROUTES:
+            skipped["unrecognised"] += 1
+            continue
+        yield record.get("ts"), method, record["path"], record.get("body") or {}
+
+
+def service_caller(database_uri):
+    engine = create_engine(database_uri, **engine_options(database_uri))
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = sessionmaker(bind=engine)
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    def call(method, path, body):
+        if (method, path) == ("POST", "/allocation"):
+            services.allocate(body["orderid"], body["sku"], body["qty"], uow=uow())
+        elif (method, path) == ("POST", "/allocations"):
+            lines = [(l["orderid"], l["sku"], l["qty"]) for l in body["lines"]]
+            services.allocate_many(lines, uow=uow())
+        elif (method, path) == ("DELETE", "/allocation"):
+            services.deallocate(body["orderid"], body["sku"], uow=uow())
+        else:
+            eta = body.get("eta")
+            eta = datetime.fromisoformat(eta).date() if eta else None
+            services.add_batch(
+                body["batchref"], body["sku"], body["qty"], eta, uow=uow()
+            )
+
+    return call
+
+
+def engine_options(database_uri):
+    if database_uri.startswith("sqlite"):
+        return dict(connect_args={"check_same_thread": False})
+    return config.get_engine_options()
+
+
+def http_caller(url):
+    import requests
+
+    session = requests.Session()
+
+    def call(method, path, body):
+        response = session.request(method, f"{url}{path}", json=body)
+        if response.status_code >= 400:
+            raise HttpError(response.status_code)
+
+    return call
+
+
+class HttpError(Exception):
+    pass
+
+
+def error_kind(error):
+    if isinstance(error, HttpError):
+        return f"HTTP {error}"
+    return type(error).__name__
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = Counter()
+
+    def record(self, seconds, error=None):
+        with self._lock:
+            self.latencies.append(seconds)
+            if error is not None:
+                self.errors[error_kind(error)] += 1
+
+    def report(self, wall_seconds):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {"requests": 0}
+        histogram = Counter()
+        for seconds in latencies:
+            ms = seconds * 1000
+            bound = next((b for b in BUCKETS_MS if ms <= b), None)
+            histogram[f"<={bound}ms" if bound else f">{BUCKETS_MS[-1]}ms"] += 1
+        return {
+            "requests": len(latencies),
+            "requests_per_sec": round(len(latencies) / wall_seconds, 1),
+            "p50_ms": round(statistics.median(latencies) * 1000, 3),
+            "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+            "histogram": {
+                label: histogram[label]
+                for label in [f"<={b}ms" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+                if histogram[label]
+            },
+            "errors": dict(self.errors),
+        }
+
+
+def replay(requests, call, clients, speed, rate):
+    """
+    Send each (ts, method, path, body) request through call, keeping the
+    recorded gaps between requests scaled by 1/speed and at most `rate`
+    requests a second. Latency counts from when a request was due, so time
+    spent waiting for a free client is included; unscheduled requests (speed
+    0, no rate) are timed from when a client picks them up.
+    """
+    recorder = Recorder()
+
+    def timed(due, method, path, body):
+        if due is None:
+            due = time.perf_counter()
+        try:
+            call(method, path, body)
+        except Exception as e:
+            recorder.record(time.perf_counter() - due, e)
+        else:
+            recorder.record(time.perf_counter() - due)
+
+    start = time.perf_counter()
+    first_ts, next_slot = None, start
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for ts, method, path, body in requests:
+            due, scheduled = start, bool(rate)
+            if speed and ts is not None:
+                first_ts = ts if first_ts is None else first_ts
+                due, scheduled = start + (ts - first_ts) / speed, True
+            if rate:
+                due, next_slot = max(due, next_slot), max(due, next_slot) + 1 / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(timed, due if scheduled else None, method, path, body)
+    return recorder.report(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("capture", type=argparse.FileType())
+    parser.add_argument("--target", choices=["services", "http"], default="services")
+    parser.add_argument(
+        "--database",
+        default=config.get_postgres_uri(),
+        help="Database for --target services (default: the configured Postgres).",
+    )
+    parser.add_argument("--url", default=config.get_api_url())
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="Time compression: 10 replays ten times faster, 0 ignores timestamps.",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Most requests a second; 0 for no cap."
+    )
+    args = parser.parse_args()
+
+    skipped = Counter()
+    if args.target == "services":
+        call = service_caller(args.database)
+    else:
+        call = http_caller(args.url)
+    report = replay(
+        read_requests(args.capture, skipped), call, args.clients, args.speed, args.rate
+    )
+    report["skipped"] = dict(skipped)
+    print(json.dumps(report, indent=2))
+    if not report["requests"]:
+        print("no replayable requests in the capture", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
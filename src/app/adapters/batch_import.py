@@ -0,0 +1,219 @@
+"""
+Bulk loading of new batches, straight into the tables rather than through
+Product.add_batch: tens of thousands of rows at a time, streamed, in one
+transaction per chunk. Every product a chunk adds batches to gets its
+version_number bumped, so cached products and units of work that loaded
+the old version see the change instead of overwriting it.
+"""
+
+import csv
+import io
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Iterable, Iterator, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection, Engine
+
+from app.adapters import orm
+
+FORMATS = ("csv", "jsonl")
+MAX_REPORTED_ERRORS = 100
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    imported: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    errors: List[dict] = field(default_factory=list)
+    skus: set = field(default_factory=set)
+
+    @property
+    def products(self) -> int:
+        return len(self.skus)
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def add_error(self, line: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def to_dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "imported": self.imported,
+            "failed": self.failed,
+            "products": self.products,
+            "seconds": round(self.seconds, 3),
+            "rows_per_sec": round(self.rows_per_sec, 1),
+            "errors": self.errors,
+        }
+
+
+def read_records(lines: Iterable[str], format: str) -> Iterator[Tuple[int, object]]:
+    """(line number, record) for each row of CSV with a header, or of JSONL."""
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+    elif format == "jsonl":
+        for line_num, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_num, json.loads(line)
+            except ValueError:
+                yield line_num, None
+    else:
+        raise ValueError(f"Unknown import format: {format}")
+
+
+def parse_batch(record) -> dict:
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    row = {}
+    for field_name in ("batchref", "sku"):
+        value = str(record.get(field_name) or "").strip()
+        if not value:
+            raise ValueError(f"missing {field_name}")
+        row[field_name] = value
+    try:
+        row["qty"] = int(record.get("qty"))
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid qty: {record.get('qty')!r}")
+    if row["qty"] <= 0:
+        raise ValueError(f"invalid qty: {record.get('qty')!r}")
+    eta = record.get("eta") or None
+    try:
+        row["eta"] = date.fromisoformat(eta) if eta else None
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid eta: {eta!r}")
+    return row
+
+
+def import_batches(
+    engine: Engine, lines: Iterable[str], format: str, chunk_size: int = 1000
+) -> ImportReport:
+    report = ImportReport()
+    start = time.perf_counter()
+    chunk = []
+    for line_num, record in read_records(lines, format):
+        report.rows += 1
+        try:
+            chunk.append((line_num, parse_batch(record)))
+        except ValueError as e:
+            report.add_error(line_num, str(e))
+        if len(chunk) >= chunk_size:
+            _import_chunk(engine, chunk, report)
+            chunk = []
+    if chunk:
+        _import_chunk(engine, chunk, report)
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def _import_chunk(engine: Engine, chunk: List[Tuple[int, dict]], report: ImportReport):
+    rows = chunk
+    try:
+        with engine.begin() as connection:
+            rows = _new_batches(connection, chunk, report)
+            if not rows:
+                return
+            skus = {row["sku"] for _, row in rows}
+            _upsert_products(connection, skus)
+            _insert_batches(connection, [row for _, row in rows])
+    except Exception as e:
+        for line_num, _ in rows:
+            report.add_error(line_num, f"chunk failed: {e}")
+        return
+    report.imported += len(rows)
+    report.skus |= skus
+
+
+def _new_batches(
+    connection: Connection, chunk: List[Tuple[int, dict]], report: ImportReport
+) -> List[Tuple[int, dict]]:
+    """The chunk's rows, less those whose batch reference is already taken."""
+    refs = {row["batchref"] for _, row in chunk}
+    taken = {
+        ref
+        for [ref] in connection.execute(
+            select([orm.batches.c.batch_ref]).where(orm.batches.c.batch_ref.in_(refs))
+        )
+    }
+    rows = []
+    for line_num, row in chunk:
+        if row["batchref"] in taken:
+            report.add_error(line_num, f"batch {row['batchref']} already exists")
+        else:
+            taken.add(row["batchref"])
+            rows.append((line_num, row))
+    return rows
+
+
+def _upsert_products(connection: Connection, skus: set):
+    products = orm.product
+    bump = {"version_number": products.c.version_number + 1}
+    if connection.dialect.name == "postgresql":
+        insert = postgresql.insert(products).values([{"sku": sku} for sku in skus])
+        connection.execute(
+            insert.on_conflict_do_update(index_elements=[products.c.sku], set_=bump)
+        )
+        return
+    existing = {
+        sku
+        for [sku] in connection.execute(
+            select([products.c.sku]).where(products.c.sku.in_(skus))
+        )
+    }
+    if existing:
+        connection.execute(
+            products.update().where(products.c.sku.in_(existing)).values(**bump)
+        )
+    if skus - existing:
+        connection.execute(products.insert(), [{"sku": s} for s in skus - existing])
+
+
+def _insert_batches(connection: Connection, rows: List[dict]):
+    if connection.dialect.name == "postgresql":
+        _copy_batches(connection, rows)
+        return
+    connection.execute(
+        orm.batches.insert().values(
+            [
+                {
+                    "batch_ref": row["batchref"],
+                    "sku": row["sku"],
+                    "initial_quantity": row["qty"],
+                    "eta": row["eta"],
+                }
+                for row in rows
+            ]
+        )
+    )
+
+
+def _copy_batches(connection: Connection, rows: List[dict]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        eta = row["eta"].isoformat() if row["eta"] else None
+        writer.writerow([row["batchref"], row["sku"], row["qty"], eta])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY batches (batch_ref, sku, initial_quantity, eta)"
+            " FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+    finally:
+        cursor.close()
@@ -0,0 +1,89 @@
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy.engine import Connection, Engine
+
+
+class CommitGroup:
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.transaction = connection.begin()
+        self.opened = time.monotonic()
+        self.members = 0
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class GroupCommitter:
+    """
+    Shares one database transaction, and so one COMMIT, between the units
+    of work that commit within max_delay of each other, up to max_size of
+    them. Units of work take turns writing on the group's connection, each
+    inside its own savepoint, so one that fails rolls back alone; the others
+    wait for the group's COMMIT and share its outcome.
+
+    A turn lasts from a unit of work's first write to its commit. Its reads
+    and domain work before that run on connections of their own, alongside
+    the other members', so only the writes are serialized.
+    """
+
+    def __init__(self, engine: Engine, max_size: int = 50, max_delay: float = 0.002):
+        self._engine = engine
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._turn = threading.local()
+        self._group: Optional[CommitGroup] = None
+
+    def has_turn(self) -> bool:
+        """Whether the calling thread is between join() and leave()."""
+        return getattr(self._turn, "held", False)
+
+    def join(self) -> CommitGroup:
+        """Take a turn on the open group's connection, opening a group if needed."""
+        self._lock.acquire()
+        try:
+            if self._group is None:
+                self._group = CommitGroup(self._engine.connect())
+        except Exception:
+            self._lock.release()
+            raise
+        self._turn.held = True
+        return self._group
+
+    def leave(self, group: CommitGroup, committed: bool, close: bool = False):
+        """
+        End a turn. Committed work counts towards filling the group; close
+        commits the group straight away, e.g. so that a retry after a
+        conflict gets a fresh transaction.
+        """
+        try:
+            if committed:
+                group.members += 1
+            if close or group.members == 0 or group.members >= self.max_size:
+                self._close(group)
+        finally:
+            self._turn.held = False
+            self._lock.release()
+
+    def wait(self, group: CommitGroup):
+        """Block until the group has committed, raising its error if it failed."""
+        remaining = group.opened + self.max_delay - time.monotonic()
+        if not group.done.wait(max(remaining, 0)):
+            with self._lock:
+                if self._group is group:
+                    self._close(group)
+            group.done.wait()
+        if group.error is not None:
+            raise group.error
+
+    def _close(self, group: CommitGroup):
+        self._group = None
+        try:
+            group.transaction.commit()
+        except Exception as e:
+            group.error = e
+        finally:
+            group.connection.close()
+            group.done.set()
@@ -0,0 +1,62 @@
+import abc
+import time
+from typing import Callable, Optional
+
+from sqlalchemy import select
+
+from app.adapters.orm import idempotency_keys
+
+
+class AbstractIdempotencyKeyRepository(abc.ABC):
+    """Batch references of allocations already made, by the client's key."""
+
+    @abc.abstractmethod
+    def add(self, key: str, batchref: str):
+        pass
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+
+class SqlAlchemyIdempotencyKeyRepository(AbstractIdempotencyKeyRepository):
+    def __init__(self, session, ttl: float, flush: Callable[[], None]):
+        self.session = session
+        self.ttl = ttl
+        self._flush = flush
+
+    def add(self, key: str, batchref: str):
+        # Flush the allocation first so that a concurrent request with the
+        # same key conflicts on the product's version rather than on the
+        # key's primary key. The unit of work's flush raises that conflict
+        # as a ConcurrencyError, so the request is retried and finds the key.
+        self._flush()
+        now = time.time()
+        # An expired row may still be waiting to be purged.
+        self.session.execute(
+            idempotency_keys.delete().where(
+                (idempotency_keys.c.key == key)
+                & (idempotency_keys.c.created_at < now - self.ttl)
+            )
+        )
+        self.session.execute(
+            idempotency_keys.insert().values(key=key, batchref=batchref, created_at=now)
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        return self.session.execute(
+            select([idempotency_keys.c.batchref]).where(
+                (idempotency_keys.c.key == key)
+                & (idempotency_keys.c.created_at >= time.time() - self.ttl)
+            )
+        ).scalar()
+
+
+def purge_expired_keys(connection, ttl: float) -> int:
+    """Delete keys older than ttl seconds; returns how many went."""
+    result = connection.execute(
+        idempotency_keys.delete().where(
+            idempotency_keys.c.created_at < time.time() - ttl
+        )
+    )
+    return result.rowcount
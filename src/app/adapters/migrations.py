@@ -0,0 +1,79 @@
+from sqlalchemy import String, inspect, literal, select
+
+from app.adapters import orm
+
+
+def add_batches_allocated_quantity(connection):
+    columns = {c["name"] for c in inspect(connection).get_columns("batches")}
+    if "allocated_quantity" not in columns:
+        connection.execute(
+            "ALTER TABLE batches"
+            " ADD COLUMN allocated_quantity INTEGER NOT NULL DEFAULT 0"
+        )
+        orm.reconcile_allocated_quantities(connection, fix=True)
+
+
+def convert_batches_eta_to_date(connection):
+    # eta used to be a string column holding ISO dates, or datetimes where
+    # a datetime was passed in.
+    if connection.dialect.name == "postgresql":
+        columns = {c["name"]: c for c in inspect(connection).get_columns("batches")}
+        if isinstance(columns["eta"]["type"], String):
+            connection.execute(
+                "ALTER TABLE batches ALTER COLUMN eta TYPE DATE"
+                " USING NULLIF(eta, '')::date"
+            )
+        return
+    # SQLite keeps the declared type and stores dates as 'YYYY-MM-DD' text,
+    # so only the values with a time part need rewriting.
+    connection.execute(
+        "UPDATE batches SET eta = NULLIF(substr(eta, 1, 10), '')"
+        " WHERE eta = '' OR length(eta) > 10"
+    )
+
+
+def create_missing_indexes(connection):
+    inspector = inspect(connection)
+    for table in orm.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+def drop_replaced_indexes(connection):
+    existing = {index["name"] for index in inspect(connection).get_indexes("batches")}
+    # Covered by ix_batches_sku_eta.
+    if "ix_batches_sku" in existing:
+        connection.execute("DROP INDEX ix_batches_sku")
+
+
+def fill_allocations_view(connection):
+    if _is_empty(connection, orm.allocations_view) and not _is_empty(
+        connection, orm.allocations
+    ):
+        orm.rebuild_allocations_view(connection)
+
+
+def _is_empty(connection, table):
+    return (
+        connection.execute(select([literal(1)]).select_from(table).limit(1)).first()
+        is None
+    )
+
+
+# Brings databases created by older versions of orm.metadata up to date.
+# Each migration checks whether it has already been applied.
+MIGRATIONS = [
+    add_batches_allocated_quantity,
+    convert_batches_eta_to_date,
+    create_missing_indexes,
+    drop_replaced_indexes,
+    fill_allocations_view,
+]
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            migration(connection)
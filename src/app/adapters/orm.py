@@ -1,6 +1,20 @@
+import sys
 import time
-from sqlalchemy import MetaData, Table, Column, String, Integer, ForeignKey
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy import (
+    MetaData,
+    Table,
+    Column,
+    Date,
+    String,
+    Integer,
+    Float,
+    ForeignKey,
+    Index,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.orm import Session, attributes, mapper, relationship
 from sqlalchemy.exc import OperationalError
 from app.domain.model import OrderLine, Batch, Product
 
@@ -13,6 +27,7 @@ order_lines = Table(
     Column("orderid", String(255), nullable=False),
     Column("sku", String(255), nullable=False),
     Column("qty", Integer, nullable=False),
+    Index("ix_order_lines_orderid_sku", "orderid", "sku"),
 )
 
 batches = Table(
@@ -27,7 +42,11 @@ batches = Table(
         nullable=False,
     ),
     Column("initial_quantity", Integer, nullable=False),
-    Column("eta", String(255)),
+    Column("eta", Date),
+    Column("allocated_quantity", Integer, nullable=False, server_default="0"),
+    Index("ix_batches_batch_ref", "batch_ref", unique=True),
+    # Also serves lookups by sku alone.
+    Index("ix_batches_sku_eta", "sku", "eta"),
 )
 
 allocations = Table(
@@ -36,6 +55,8 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", Integer, ForeignKey("order_lines.id")),
     Column("batch_id", Integer, ForeignKey("batches.id")),
+    Index("ix_allocations_orderline_id", "orderline_id", unique=True),
+    Index("ix_allocations_batch_id", "batch_id"),
 )
 
 product = Table(
@@ -45,21 +66,127 @@ product = Table(
     Column("version_number", Integer, nullable=False, server_default="0"),
 )
 
+# Read model of where each order line went, written alongside allocations
+# by _update_allocations_view and read without the mappers by app.views.
+allocations_view = Table(
+    "allocations_view",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("batchref", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Index("ix_allocations_view_orderid_sku", "orderid", "sku"),
+)
+
 
-def start_mappers():
+# Results of allocations made with a client's idempotency key; rows older
+# than the configured TTL are ignored and purged.
+idempotency_keys = Table(
+    "idempotency_keys",
+    metadata,
+    Column("key", String(255), primary_key=True),
+    Column("batchref", String(255), nullable=False),
+    Column("created_at", Float, nullable=False),
+    Index("ix_idempotency_keys_created_at", "created_at"),
+)
+
+
+def start_mappers(lazy="select"):
+    """
+    Map the domain model onto the tables. ``lazy`` is the SQLAlchemy loader
+    strategy for Product.batches and Batch._allocations when a query doesn't
+    choose one itself, e.g. "select", "selectin" or "joined".
+    """
     lines_mapper = mapper(OrderLine, order_lines)
     batches_mapper = mapper(
         Batch,
         batches,
         properties={
+            "_allocated_quantity": batches.c.allocated_quantity,
             "_allocations": relationship(
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
-            )
+                lazy=lazy,
+            ),
         },
     )
-    mapper(Product, product, properties={"batches": relationship(batches_mapper)})
+    mapper(
+        Product,
+        product,
+        properties={"batches": relationship(batches_mapper, lazy=lazy)},
+        version_id_col=product.c.version_number,
+        version_id_generator=False,
+    )
+    event.listen(OrderLine, "load", _intern_sku)
+    for cls in (Batch, Product):
+        event.listen(cls, "load", _invalidate_allocation_cache)
+        event.listen(cls, "expire", _invalidate_allocation_cache)
+    if not event.contains(Session, "after_flush", _update_allocations_view):
+        event.listen(Session, "after_flush", _update_allocations_view)
+
+
+def _intern_sku(line, *args):
+    # As OrderLine.__post_init__ does; written to __dict__ so as not to
+    # record a change.
+    line.__dict__["sku"] = sys.intern(line.__dict__["sku"])
+
+
+def _invalidate_allocation_cache(instance, *args):
+    # Expire also fires for instances that have already been garbage collected.
+    if instance is not None:
+        instance.invalidate_allocation_cache()
+
+
+def _update_allocations_view(session, flush_context):
+    added, removed = [], []
+    for batch in session.new | session.dirty:
+        if not isinstance(batch, Batch):
+            continue
+        history = attributes.get_history(batch, "_allocations")
+        for lines, changes in ((history.added, added), (history.deleted, removed)):
+            changes.extend(
+                dict(orderid=l.orderid, sku=l.sku, batchref=batch.batch_ref, qty=l.qty)
+                for l in lines
+            )
+    connection = session.connection()
+    view = allocations_view.c
+    # A batch holds each (orderid, sku, qty) line at most once, so this
+    # matches the one row for the line even when the order has others there.
+    for row in removed:
+        connection.execute(
+            allocations_view.delete().where(
+                (view.orderid == row["orderid"])
+                & (view.sku == row["sku"])
+                & (view.batchref == row["batchref"])
+                & (view.qty == row["qty"])
+            )
+        )
+    if added:
+        connection.execute(allocations_view.insert(), added)
+
+
+def rebuild_allocations_view(connection):
+    """Refill allocations_view from the allocations table."""
+    connection.execute(allocations_view.delete())
+    connection.execute(
+        allocations_view.insert().from_select(
+            ["orderid", "sku", "batchref", "qty"],
+            select(
+                [
+                    order_lines.c.orderid,
+                    order_lines.c.sku,
+                    batches.c.batch_ref,
+                    order_lines.c.qty,
+                ]
+            ).select_from(
+                allocations.join(
+                    order_lines, allocations.c.orderline_id == order_lines.c.id
+                ).join(batches, allocations.c.batch_id == batches.c.id)
+            ),
+        )
+    )
 
 
 def wait_for_db(engine):
@@ -72,11 +199,56 @@ def wait_for_db(engine):
     raise OperationalError("Database never came up")
 
 
+def reconcile_allocated_quantities(connection, fix=False):
+    """
+    Check batches.allocated_quantity against the allocations table and
+    return (batch_ref, stored, actual) for every batch that disagrees. With
+    fix=True the stored totals are overwritten with the actual ones and the
+    products they belong to get their version_number bumped, so cached
+    copies holding the old totals are reloaded.
+    """
+    actual = (
+        select([func.coalesce(func.sum(order_lines.c.qty), 0)])
+        .select_from(
+            allocations.join(
+                order_lines, allocations.c.orderline_id == order_lines.c.id
+            )
+        )
+        .where(allocations.c.batch_id == batches.c.id)
+        .as_scalar()
+    )
+    mismatched = batches.c.allocated_quantity != actual
+    rows = list(
+        connection.execute(
+            select(
+                [
+                    batches.c.batch_ref,
+                    batches.c.allocated_quantity,
+                    actual,
+                    batches.c.sku,
+                ]
+            )
+            .where(mismatched)
+            .order_by(batches.c.id)
+        )
+    )
+    if fix and rows:
+        connection.execute(
+            batches.update().where(mismatched).values(allocated_quantity=actual)
+        )
+        connection.execute(
+            product.update()
+            .where(product.c.sku.in_({row.sku for row in rows}))
+            .values(version_number=product.c.version_number + 1)
+        )
+    return [(batch_ref, stored, total) for batch_ref, stored, total, _ in rows]
+
+
 def create_tables(engine):
     metadata.create_all(engine)
 
 
-def init(db_engine):
+def init(db_engine, lazy="select"):
     wait_for_db(db_engine)
     create_tables(db_engine)
-    start_mappers()
+    start_mappers(lazy=lazy)
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from app.domain.model import Product
+
+
+class ProductCache:
+    """
+    Products kept in memory between units of work, least recently used
+    first out. A product is checked out to one unit of work at a time and
+    handed back when that unit of work commits, so a cached product is
+    never shared between sessions or left holding uncommitted changes.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._products = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def checkout(self, sku: str, version_number: int) -> Optional[Product]:
+        """
+        Take the cached product for sku if it is still at version_number,
+        the version currently stored in the database.
+        """
+        with self._lock:
+            product = self._products.pop(sku, None)
+            if product is not None and product.version_number == version_number:
+                self.hits += 1
+                return product
+            if product is not None:
+                self.stale += 1
+            self.misses += 1
+            return None
+
+    def put(self, product: Product) -> None:
+        with self._lock:
+            self._products[product.sku] = product
+            self._products.move_to_end(product.sku)
+            while len(self._products) > self.max_size:
+                self._products.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            self._products.pop(sku, None)
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._products),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+            }
@@ -1,5 +1,17 @@
 import abc
-from app.domain.model import Product
+from typing import Awaitable, Callable, Optional
+from sqlalchemy.orm import contains_eager, joinedload, noload, selectinload
+from app.adapters.product_cache import ProductCache
+from app.domain.model import Batch, Product
+
+# How SqlAlchemyProductRepository.get loads a product's batches and their
+# allocated lines:
+#   lazy     - whatever the mappers are configured with (one query per batch
+#              under the default lazy="select")
+#   selectin - three queries: products, batches, lines
+#   joined   - one query with eager LEFT OUTER JOINs
+#   single   - one hand-written query joining batches and lines directly
+LOADING_STRATEGIES = ("lazy", "selectin", "joined", "single")
 
 
 class AbstractProductRepository(abc.ABC):
@@ -11,13 +23,150 @@ class AbstractProductRepository(abc.ABC):
     def get(self, sku: str) -> Product:
         pass
 
+    def get_for_allocation(self, sku: str) -> Product:
+        """
+        A product that only needs to take new allocations. Repositories may
+        leave the batches' existing lines unloaded; see
+        Batch.mark_allocations_unloaded.
+        """
+        return self.get(sku)
+
 
 class SqlAlchemyProductRepository(AbstractProductRepository):
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        loading="selectin",
+        write_only_allocations=False,
+        cache: Optional[ProductCache] = None,
+    ):
+        if loading not in LOADING_STRATEGIES:
+            raise ValueError(f"Unknown loading strategy: {loading}")
         self.session = session
+        self.loading = loading
+        self.write_only_allocations = write_only_allocations
+        self.cache = cache
+        self.seen = {}
 
     def add(self, product: Product):
         self.session.add(product)
+        self.seen[product.sku] = product
 
     def get(self, sku: str) -> Product:
-        return self.session.query(Product).filter_by(sku=sku).first()
+        if self.cache is None:
+            product = self._load(sku)
+        else:
+            product = self._get_cached(sku)
+        if product is not None:
+            self.seen[sku] = product
+        return product
+
+    def _get_cached(self, sku: str) -> Optional[Product]:
+        # Only the version is read. A cached product at that version has the
+        # same state as the database, and the version check on flush still
+        # catches anyone who commits after this read.
+        row = self.session.query(Product.version_number).filter_by(sku=sku).first()
+        if row is None:
+            self.cache.invalidate(sku)
+            return None
+        product = self.cache.checkout(sku, row.version_number)
+        if product is None:
+            return self._load(sku)
+        self.session.add(product)
+        return product
+
+    def _load(self, sku: str) -> Optional[Product]:
+        query = self.session.query(Product)
+        if self.loading == "selectin":
+            query = query.options(
+                selectinload(Product.batches).selectinload(Batch._allocations)
+            )
+        elif self.loading == "joined":
+            query = query.options(
+                joinedload(Product.batches).joinedload(Batch._allocations)
+            )
+        elif self.loading == "single":
+            query = (
+                query.outerjoin(Product.batches)
+                .outerjoin(Batch._allocations)
+                .options(
+                    contains_eager(Product.batches).contains_eager(Batch._allocations)
+                )
+            )
+            # No LIMIT: it would cut the joined rows, not the products.
+            return next(iter(query.filter(Product.sku == sku).all()), None)
+        return query.filter_by(sku=sku).first()
+
+    def get_for_allocation(self, sku: str) -> Product:
+        # Cached products are always fully loaded.
+        if not self.write_only_allocations or self.cache is not None:
+            return self.get(sku)
+        # Batches come with their stored allocated_quantity but no lines;
+        # lines allocated now are still inserted on flush.
+        product = (
+            self.session.query(Product)
+            .options(selectinload(Product.batches).noload(Batch._allocations))
+            .filter_by(sku=sku)
+            .first()
+        )
+        if product is not None:
+            for batch in product.batches:
+                batch.mark_allocations_unloaded()
+        return product
+
+    def get_batchref_with_capacity(self, sku: str, qty: int) -> Optional[str]:
+        """
+        The batch Product.allocate would choose for a line of qty, answered
+        from the batches table alone without loading any order lines. Batches
+        in stock are tried first, then those on their way by eta; each query
+        walks ix_batches_sku_eta in allocation order and stops at the first
+        batch with capacity.
+        """
+        with_capacity = self.session.query(Batch.batch_ref).filter(
+            Batch.sku == sku,
+            Batch.initial_quantity - Batch._allocated_quantity >= qty,
+        )
+        row = (
+            with_capacity.filter(Batch.eta.is_(None)).order_by(Batch.id).first()
+            or with_capacity.filter(Batch.eta.isnot(None))
+            .order_by(Batch.eta, Batch.id)
+            .first()
+        )
+        return row.batch_ref if row else None
+
+
+class AbstractAsyncProductRepository(abc.ABC):
+    @abc.abstractmethod
+    def add(self, product: Product):
+        pass
+
+    @abc.abstractmethod
+    async def get(self, sku: str) -> Product:
+        pass
+
+    async def get_for_allocation(self, sku: str) -> Product:
+        return await self.get(sku)
+
+
+class AsyncSqlAlchemyProductRepository(AbstractAsyncProductRepository):
+    """
+    A SqlAlchemyProductRepository whose queries are awaited. ``run`` runs a
+    blocking call off the event loop and returns its result.
+    """
+
+    def __init__(
+        self,
+        repository: SqlAlchemyProductRepository,
+        run: Callable[..., Awaitable],
+    ):
+        self._repository = repository
+        self._run = run
+
+    def add(self, product: Product):
+        self._repository.add(product)
+
+    async def get(self, sku: str) -> Product:
+        return await self._run(self._repository.get, sku)
+
+    async def get_for_allocation(self, sku: str) -> Product:
+        return await self._run(self._repository.get_for_allocation, sku)
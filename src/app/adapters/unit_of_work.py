@@ -1,16 +1,38 @@
 import abc
+import asyncio
+import contextlib
+import functools
+from concurrent.futures import Executor, ThreadPoolExecutor
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy import create_engine, event, inspect
 
+from app.adapters.group_commit import GroupCommitter
+from app.adapters.idempotency_repository import (
+    AbstractIdempotencyKeyRepository,
+    SqlAlchemyIdempotencyKeyRepository,
+)
+from app.adapters.product_cache import ProductCache
 from app.adapters.product_repository import (
+    AbstractAsyncProductRepository,
     AbstractProductRepository,
+    AsyncSqlAlchemyProductRepository,
     SqlAlchemyProductRepository,
 )
-from app import config
+from app import config, instrumentation
+
+# Postgres serialization_failure and deadlock_detected
+RETRYABLE_PGCODES = {"40001", "40P01"}
+
+
+class ConcurrencyError(Exception):
+    """Another transaction changed the aggregate first; the work can be retried."""
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: AbstractProductRepository
+    idempotency_keys: AbstractIdempotencyKeyRepository
 
     def __enter__(self):
         pass
@@ -26,30 +48,258 @@ class AbstractUnitOfWork(abc.ABC):
     def rollback(self):
         pass
 
+    def savepoint(self):
+        """
+        A block of work inside the open unit of work that fails on its own:
+        if it raises, including while its changes are written, only those
+        changes are undone. Units of work that can't do that run it as is.
+        """
+        return contextlib.nullcontext()
+
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
+# The one engine, and so the one connection pool, shared by the process.
+DEFAULT_ENGINE = create_engine(config.get_postgres_uri(), **config.get_engine_options())
+DEFAULT_SESSION_FACTORY = sessionmaker(bind=DEFAULT_ENGINE)
+DEFAULT_PRODUCT_CACHE = (
+    ProductCache(config.get_product_cache_size())
+    if config.get_product_cache_size()
+    else None
+)
+DEFAULT_GROUP_COMMITTER = (
+    GroupCommitter(DEFAULT_ENGINE, **config.get_group_commit_settings())
+    if config.get_group_commit_settings()["max_size"]
+    else None
 )
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        loading=None,
+        write_only_allocations=None,
+        product_cache=DEFAULT_PRODUCT_CACHE,
+        group_committer=DEFAULT_GROUP_COMMITTER,
+    ):
         self._session_factory = session_factory
+        self._loading = loading or config.get_loading_strategy()
+        if write_only_allocations is None:
+            write_only_allocations = config.get_write_only_allocations()
+        self._write_only_allocations = write_only_allocations
+        self._product_cache = product_cache
+        self._group_committer = group_committer
+        self._grouped = False
+        self._group = None
 
     def __enter__(self):
-        self._session = self._session_factory()
-        self.products = SqlAlchemyProductRepository(self._session)
+        with instrumentation.stage("session_open"):
+            self._open_session()
+        if self._product_cache is not None:
+            # Committed products go back to the cache as they are.
+            self._session.expire_on_commit = False
+        self.products = SqlAlchemyProductRepository(
+            self._session,
+            self._loading,
+            self._write_only_allocations,
+            self._product_cache,
+        )
+        self.idempotency_keys = SqlAlchemyIdempotencyKeyRepository(
+            self._session, config.get_idempotency_key_ttl(), self.flush
+        )
         super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
         self._session.close()
 
+    def _open_session(self):
+        # A unit of work opened while this thread already has a turn on the
+        # group's connection would wait for that turn forever, so it commits
+        # on its own instead.
+        self._grouped = (
+            self._group_committer is not None and not self._group_committer.has_turn()
+        )
+        if not self._grouped:
+            self._session = self._session_factory()
+        else:
+            # Until its first write a grouped unit of work reads outside any
+            # transaction, on a pooled connection of its own, alongside the
+            # other members; only its writes and commit take a turn.
+            self._session = self._session_factory(autocommit=True)
+            event.listen(self._session, "before_flush", self._take_turn_to_flush)
+
+    def _take_turn_to_flush(self, session, flush_context, instances):
+        self._take_turn()
+
+    def _take_turn(self):
+        if self._group is not None:
+            return
+        self._group = self._group_committer.join()
+        self._savepoint = self._group.connection.begin_nested()
+        self._session.bind = self._group.connection
+        self._session.begin()
+
     def rollback(self):
-        self._session.rollback()
+        if not self._grouped:
+            self._session.rollback()
+        elif self._group is not None:
+            self._leave_group(committed=False)
 
     def commit(self):
-        self._session.commit()
+        with instrumentation.stage("commit"):
+            self._commit()
+
+    def flush(self):
+        """Write pending changes ahead of commit, failing as commit would."""
+        if self._grouped:
+            # Writes made with session.execute after this must go on the
+            # group's connection too.
+            self._take_turn()
+        with self._conflicts_as_concurrency_errors():
+            self._session.flush()
+
+    def _commit(self):
+        with self._conflicts_as_concurrency_errors():
+            if not self._grouped:
+                self._session.commit()
+            else:
+                self._commit_in_group()
+        if self._product_cache is not None:
+            self._session.expunge_all()
+            for product in self.products.seen.values():
+                self._product_cache.put(product)
+
+    @contextlib.contextmanager
+    def savepoint(self):
+        if self._grouped:
+            self._take_turn()
+        savepoint = self._session.begin_nested()
+        try:
+            yield
+            with self._conflicts_as_concurrency_errors():
+                savepoint.commit()
+        except Exception:
+            # Also after a failed flush, which leaves it inactive but open.
+            savepoint.rollback()
+            self._forget_rolled_back_products()
+            raise
+
+    @contextlib.contextmanager
+    def _conflicts_as_concurrency_errors(self):
+        try:
+            yield
+        except StaleDataError as e:
+            self._invalidate_cached_products()
+            raise ConcurrencyError(str(e)) from e
+        except DBAPIError as e:
+            if getattr(e.orig, "pgcode", None) in RETRYABLE_PGCODES:
+                self._invalidate_cached_products()
+                raise ConcurrencyError(str(e)) from e
+            raise
+
+    def _forget_rolled_back_products(self):
+        # Rolling back a savepoint expires what it changed and drops what it
+        # added. Neither may go back to the cache as it is; a later get
+        # reloads them.
+        for sku, product in list(self.products.seen.items()):
+            state = inspect(product)
+            if not state.persistent or state.expired_attributes:
+                del self.products.seen[sku]
+                if self._product_cache is not None:
+                    self._product_cache.invalidate(sku)
+
+    def _commit_in_group(self):
+        self._take_turn()
+        try:
+            self._session.commit()
+            self._savepoint.commit()
+        except Exception:
+            self._leave_group(committed=False, close=True)
+            raise
+        group = self._leave_group(committed=True)
+        self._group_committer.wait(group)
+
+    def _leave_group(self, committed, close=False):
+        group, self._group = self._group, None
+        try:
+            self._session.close()
+            if self._savepoint.is_active:
+                self._savepoint.rollback()
+        finally:
+            self._group_committer.leave(group, committed, close)
+        return group
+
+    def _invalidate_cached_products(self):
+        if self._product_cache is not None:
+            for sku in self.products.seen:
+                self._product_cache.invalidate(sku)
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: AbstractAsyncProductRepository
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    @abc.abstractmethod
+    async def commit(self):
+        pass
+
+    @abc.abstractmethod
+    async def rollback(self):
+        pass
+
+    @abc.abstractmethod
+    async def run_sync(self, fn, *args, **kwargs):
+        """
+        Await a synchronous service function, passing it an equivalent
+        synchronous unit of work as ``uow``, without blocking the event loop.
+        """
+
+
+def _db_thread_count():
+    options = config.get_engine_options()
+    return options["pool_size"] + options["max_overflow"]
+
+
+# Blocking database calls from async code run here. One thread per pooled
+# connection: more could only wait for a connection.
+DEFAULT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=_db_thread_count(), thread_name_prefix="db"
+)
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        executor: Executor = DEFAULT_EXECUTOR,
+        **options,
+    ):
+        self._uow = SqlAlchemyUnitOfWork(session_factory, **options)
+        self._executor = executor
+
+    async def __aenter__(self):
+        await self._run(self._uow.__enter__)
+        self.products = AsyncSqlAlchemyProductRepository(self._uow.products, self._run)
+
+    async def __aexit__(self, *args):
+        await self._run(self._uow.__exit__, *args)
+
+    async def commit(self):
+        await self._run(self._uow.commit)
+
+    async def rollback(self):
+        await self._run(self._uow.rollback)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await self._run(fn, *args, uow=self._uow, **kwargs)
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
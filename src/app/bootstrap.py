@@ -0,0 +1,16 @@
+from app import config, instrumentation
+from app.adapters import migrations, orm, unit_of_work
+from app.domain import model
+from app.service_layer import retries
+
+
+def bootstrap():
+    model.CHECK_ALLOCATED_QUANTITY = config.get_check_allocated_quantity()
+    retries.DEFAULT_POLICY = retries.RetryPolicy(**config.get_retry_settings())
+    instrumentation.enabled = config.get_instrumentation_enabled()
+    instrumentation.profile_sample_rate = config.get_profile_sample_rate()
+    instrumentation.profile_dir = config.get_profile_dir()
+    if instrumentation.enabled:
+        instrumentation.instrument_engine(unit_of_work.DEFAULT_ENGINE)
+    orm.init(db_engine=unit_of_work.DEFAULT_ENGINE)
+    migrations.migrate(unit_of_work.DEFAULT_ENGINE)
@@ -9,7 +9,85 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_engine_options():
+    options = dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        isolation_level=os.environ.get("DB_ISOLATION_LEVEL", "REPEATABLE READ"),
+    )
+    statement_timeout_ms = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+    if statement_timeout_ms:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={statement_timeout_ms}"
+        }
+    return options
+
+
+def get_group_commit_settings():
+    return dict(
+        max_size=int(os.environ.get("DB_GROUP_COMMIT_SIZE", 0)),
+        max_delay=float(os.environ.get("DB_GROUP_COMMIT_DELAY", 0.002)),
+    )
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
     return f"http://{host}:{port}"
+
+
+def get_check_allocated_quantity():
+    return os.environ.get("CHECK_ALLOCATED_QUANTITY", "") == "1"
+
+
+def get_retry_settings():
+    return dict(
+        attempts=int(os.environ.get("RETRY_ATTEMPTS", 5)),
+        base_delay=float(os.environ.get("RETRY_BASE_DELAY", 0.005)),
+        max_delay=float(os.environ.get("RETRY_MAX_DELAY", 0.2)),
+    )
+
+
+def get_loading_strategy():
+    return os.environ.get("LOADING_STRATEGY", "selectin")
+
+
+def get_write_only_allocations():
+    return os.environ.get("WRITE_ONLY_ALLOCATIONS", "") == "1"
+
+
+def get_product_cache_size():
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
+def get_allocation_engine_settings():
+    return dict(
+        shards=int(os.environ.get("ALLOCATION_ENGINE_SHARDS", 0)),
+        max_group_size=int(os.environ.get("ALLOCATION_ENGINE_GROUP_SIZE", 100)),
+        max_group_delay=float(os.environ.get("ALLOCATION_ENGINE_GROUP_DELAY", 0.002)),
+        product_cache_size=int(
+            os.environ.get("ALLOCATION_ENGINE_PRODUCT_CACHE_SIZE", 1000)
+        ),
+    )
+
+
+def get_instrumentation_enabled():
+    return os.environ.get("INSTRUMENTATION", "") == "1"
+
+
+def get_profile_sample_rate():
+    return float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+
+def get_profile_dir():
+    return os.environ.get("PROFILE_DIR", "/tmp/allocation-profiles")
+
+
+def get_idempotency_key_ttl():
+    return float(os.environ.get("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60))
+
+
+def get_simulation_processes():
+    return int(os.environ.get("SIMULATION_PROCESSES", 1))
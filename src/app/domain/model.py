@@ -1,5 +1,7 @@
+import bisect
+import sys
 from datetime import date
-from typing import Optional, NewType
+from typing import Iterator, Optional, NewType, Union
 from dataclasses import dataclass
 
 Quantity = NewType("Quantity", int)
@@ -7,19 +9,70 @@ BatchRef = NewType("BatchRef", str)
 OrderId = NewType("OrderId", str)
 Sku = NewType("Sku", str)
 
+# When set, every read of a batch's running allocated total is checked
+# against the sum of its allocated lines. Slow; meant for tests and debugging.
+CHECK_ALLOCATED_QUANTITY = False
+
 
 class OutOfStock(Exception):
     pass
 
 
+class AllocationsNotLoaded(Exception):
+    pass
+
+
 @dataclass(unsafe_hash=True)
 class OrderLine:
     orderid: OrderId
     sku: Sku
     qty: Quantity
 
+    def __post_init__(self):
+        # A product's lines all share one copy of its sku.
+        if type(self.sku) is str:
+            self.sku = sys.intern(self.sku)
+
+
+# The orderid indexes below map an orderid to its one line or batch, or to
+# a list when it has several. Nearly every order has one line per batch and
+# one batch per SKU, and a list for each would double the indexes' size.
+_MISSING = object()
+
+
+def _index_add(index: dict, orderid: OrderId, value) -> None:
+    current = index.get(orderid, _MISSING)
+    if current is _MISSING:
+        index[orderid] = value
+    elif type(current) is list:
+        if value not in current:
+            current.append(value)
+    elif current != value:
+        index[orderid] = [current, value]
+
+
+def _index_get(index: dict, orderid: OrderId) -> list:
+    current = index.get(orderid, _MISSING)
+    if current is _MISSING:
+        return []
+    return current if type(current) is list else [current]
+
+
+def _index_remove(index: dict, orderid: OrderId, value) -> None:
+    current = index[orderid]
+    if type(current) is not list:
+        del index[orderid]
+        return
+    current.remove(value)
+    if len(current) == 1:
+        index[orderid] = current[0]
+
 
 class Batch:
+    # False when only allocated_quantity is known and _allocations holds just
+    # the lines allocated since loading; see mark_allocations_unloaded.
+    _allocations_loaded = True
+
     def __init__(
         self,
         batch_ref: BatchRef,
@@ -32,27 +85,73 @@ class Batch:
         self.initial_quantity = qty
         self.eta = eta
         self._allocations = set()
+        self._allocated_quantity = 0
+        self._lines_by_orderid = {}
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
+            if self._lines_by_orderid is not None:
+                _index_add(self._lines_by_orderid, line.orderid, line)
             self._allocations.add(line)
 
     def can_deallocated(self, orderid: str, sku: str) -> bool:
-        return orderid in {a.orderid for a in self._allocations} and self.sku == sku
+        return self.sku == sku and self.has_orderid(orderid)
 
     def deallocate(self, orderid: str, sku: str):
         if self.can_deallocated(orderid, sku):
-            for line in self._allocations:
-                if line.orderid == orderid:
-                    self._allocations.remove(line)
-                    return
+            line = _index_get(self._orderid_index(), orderid)[-1]
+            _index_remove(self._lines_by_orderid, orderid, line)
+            self._allocated_quantity = self.allocated_quantity - line.qty
+            self._allocations.remove(line)
+
+    def has_orderid(self, orderid: str) -> bool:
+        return orderid in self._orderid_index()
+
+    @property
+    def orderids(self) -> set[OrderId]:
+        return set(self._orderid_index())
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
     @property
     def allocated_quantity(self) -> Quantity:
-        return sum(line.qty for line in self._allocations)
+        if CHECK_ALLOCATED_QUANTITY and self._allocations_loaded:
+            total = sum(line.qty for line in self._allocations)
+            assert self._allocated_quantity == total, (
+                f"Batch {self.batch_ref} allocated quantity is "
+                f"{self._allocated_quantity}, allocations sum to {total}"
+            )
+        return self._allocated_quantity
+
+    def invalidate_allocation_cache(self) -> None:
+        """
+        Drop the orderid index kept alongside _allocations, e.g. after the
+        ORM (re)loads it. It is rebuilt from the allocated lines on next use.
+        """
+        self._lines_by_orderid = None
+        self._allocations_loaded = True
+
+    def mark_allocations_unloaded(self) -> None:
+        """
+        Record that the existing allocated lines were not loaded. The batch
+        can still allocate, using allocated_quantity, but anything that needs
+        to find an order's lines raises AllocationsNotLoaded.
+        """
+        self._lines_by_orderid = None
+        self._allocations_loaded = False
+
+    def _orderid_index(self) -> dict[OrderId, Union[OrderLine, list[OrderLine]]]:
+        if not self._allocations_loaded:
+            raise AllocationsNotLoaded(
+                f"Allocations for batch {self.batch_ref} were not loaded"
+            )
+        if self._lines_by_orderid is None:
+            self._lines_by_orderid = {}
+            for line in self._allocations:
+                _index_add(self._lines_by_orderid, line.orderid, line)
+        return self._lines_by_orderid
 
     @property
     def available_quantity(self) -> Quantity:
@@ -79,31 +178,226 @@ class Batch:
         return self.eta > other.eta
 
 
+def _allocation_key(batch: Batch):
+    # Same ordering as sorted() over Batch.__gt__: batches without an eta
+    # (in stock) first, then by eta.
+    return (batch.eta is not None, batch.eta)
+
+
+_NO_CAPACITY = float("-inf")
+
+
+class _BatchOrder:
+    """
+    A product's batches in allocation order, with a max-tree over their
+    available quantities so the first batch that can take a line is found
+    in O(log B). Tracks changes made through Product only; Product checks
+    each batch it picks and rebuilds the order if that one was changed
+    some other way.
+    """
+
+    def __init__(self, sku: Sku, batches: list[Batch]):
+        self._sku = sku
+        # Where each batch was in the product's list when this was built.
+        self._indexes = {id(b): i for i, b in enumerate(batches)}
+        self._keys = []
+        self._batches = []
+        for batch in batches:
+            self._insort(batch)
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def __iter__(self) -> Iterator[Batch]:
+        return iter(self._batches)
+
+    def add(self, batch: Batch) -> None:
+        self._indexes[id(batch)] = len(self._indexes)
+        self._insort(batch)
+        self._rebuild()
+
+    def still_fits(self, batch: Batch, line: OrderLine, batches: list[Batch]) -> bool:
+        """
+        Whether a batch first_fit picked is still where it was among the
+        product's batches and can still take the line, i.e. neither the
+        batch nor its stock was changed behind this order's back.
+        """
+        i = self._indexes[id(batch)]
+        return i < len(batches) and batches[i] is batch and batch.can_allocate(line)
+
+    def update(self, batch: Batch) -> None:
+        i = self._size + self._positions[id(batch)]
+        self._tree[i] = self._capacity(batch)
+        i //= 2
+        while i:
+            self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+            i //= 2
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        if line.sku != self._sku:
+            return next((b for b in self._batches if b.can_allocate(line)), None)
+        if self._tree[1] < line.qty:
+            return None
+        i = 1
+        while i < self._size:
+            i = 2 * i if self._tree[2 * i] >= line.qty else 2 * i + 1
+        return self._batches[i - self._size]
+
+    def plan(self, lines: list[OrderLine]) -> list[Optional[Batch]]:
+        """
+        The batch first_fit would pick for each line if every line before it
+        had taken its quantity from the batch picked for it, worked out on a
+        copy of the tree without touching the batches.
+        """
+        tree, size, batches = list(self._tree), self._size, self._batches
+        planned = []
+        for line in lines:
+            qty = line.qty
+            if line.sku != self._sku or tree[1] < qty:
+                planned.append(None)
+                continue
+            i = 1
+            while i < size:
+                i = 2 * i if tree[2 * i] >= qty else 2 * i + 1
+            planned.append(batches[i - size])
+            tree[i] -= qty
+            i //= 2
+            while i:
+                left, right = tree[2 * i], tree[2 * i + 1]
+                highest = left if left > right else right
+                if tree[i] == highest:
+                    break
+                tree[i] = highest
+                i //= 2
+        return planned
+
+    def _capacity(self, batch: Batch):
+        if batch.sku != self._sku:
+            return _NO_CAPACITY
+        return batch.available_quantity
+
+    def _insort(self, batch: Batch) -> None:
+        key = _allocation_key(batch)
+        i = bisect.bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._batches.insert(i, batch)
+
+    def _rebuild(self) -> None:
+        self._positions = {id(b): i for i, b in enumerate(self._batches)}
+        self._size = 1
+        while self._size < len(self._batches):
+            self._size *= 2
+        self._tree = [_NO_CAPACITY] * (2 * self._size)
+        for i, batch in enumerate(self._batches):
+            self._tree[self._size + i] = self._capacity(batch)
+        for i in range(self._size - 1, 0, -1):
+            self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+
+
 class Product:
     def __init__(self, sku: Sku, batches: list[Batch], version_number=0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
+        self._batch_order = _BatchOrder(sku, batches)
+        self._batches_by_orderid = None
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            return batch.batch_ref
-        except StopIteration:
+        batch_order = self._allocation_order()
+        batch = batch_order.first_fit(line)
+        if batch is not None and not batch_order.still_fits(batch, line, self.batches):
+            batch_order = self._rebuild_allocation_order()
+            batch = batch_order.first_fit(line)
+        if batch is None:
             raise OutOfStock(f"Out of stock for sku: {line.sku}")
+        batch.allocate(line)
+        batch_order.update(batch)
+        if self._batches_by_orderid is not None and batch.has_orderid(line.orderid):
+            _index_add(self._batches_by_orderid, line.orderid, batch)
+        self.version_number += 1
+        return batch.batch_ref
+
+    def allocate_many(self, lines: list[OrderLine]) -> list[Union[str, OutOfStock]]:
+        """
+        Allocate a wave of lines with the same results as calling allocate
+        for each in turn, except that a line that doesn't fit gets an
+        OutOfStock in its place instead of raising. The wave is planned in
+        one pass over the batches' capacities and then applied; a line its
+        batch already holds takes no stock, so the rest is planned again.
+        """
+        batch_order = self._allocation_order()
+        results = []
+        while len(results) < len(lines):
+            allocated = set()
+            for line, batch in zip(
+                lines[len(results) :], batch_order.plan(lines[len(results) :])
+            ):
+                if batch is None:
+                    results.append(OutOfStock(f"Out of stock for sku: {line.sku}"))
+                    continue
+                if not batch_order.still_fits(batch, line, self.batches):
+                    # The rest is planned again on a fresh batch order.
+                    batch_order = self._rebuild_allocation_order()
+                    break
+                available = batch.available_quantity
+                batch.allocate(line)
+                allocated.add(batch)
+                results.append(batch.batch_ref)
+                self.version_number += 1
+                if self._batches_by_orderid is not None and batch.has_orderid(
+                    line.orderid
+                ):
+                    _index_add(self._batches_by_orderid, line.orderid, batch)
+                if batch.available_quantity == available:
+                    break
+            for batch in allocated:
+                batch_order.update(batch)
+        return results
 
     def deallocate(self, orderid: str, sku: str) -> None:
-        batch = next(
-            (b for b in self.batches if b.can_deallocated(orderid, sku)),
-            None,
-        )
+        batches = _index_get(self._orderid_index(), orderid)
+        batch = next((b for b in batches if b.can_deallocated(orderid, sku)), None)
         if batch is not None:
             batch.deallocate(orderid, sku)
+            if not batch.has_orderid(orderid):
+                _index_remove(self._batches_by_orderid, orderid, batch)
+            self._allocation_order().update(batch)
+            self.version_number += 1
 
     def add_batch(self, batch: Batch) -> None:
+        batch_order = self._allocation_order()
         self.batches.append(batch)
+        batch_order.add(batch)
+        if self._batches_by_orderid is not None:
+            for orderid in batch.orderids:
+                _index_add(self._batches_by_orderid, orderid, batch)
+        self.version_number += 1
+
+    def invalidate_allocation_cache(self) -> None:
+        """
+        Drop the batch order and orderid index kept alongside batches, e.g.
+        after the ORM (re)loads them. Both are rebuilt on next use.
+        """
+        self._batch_order = None
+        self._batches_by_orderid = None
+
+    def _allocation_order(self) -> _BatchOrder:
+        if self._batch_order is None or len(self._batch_order) != len(self.batches):
+            return self._rebuild_allocation_order()
+        return self._batch_order
+
+    def _rebuild_allocation_order(self) -> _BatchOrder:
+        self._batch_order = _BatchOrder(self.sku, self.batches)
+        return self._batch_order
+
+    def _orderid_index(self) -> dict[OrderId, Union[Batch, list[Batch]]]:
+        if self._batches_by_orderid is None:
+            self._batches_by_orderid = {}
+            for batch in self.batches:
+                for orderid in batch.orderids:
+                    _index_add(self._batches_by_orderid, orderid, batch)
+        return self._batches_by_orderid
 
     def __eq__(self, other):
         if not isinstance(other, Product):
@@ -0,0 +1,208 @@
+"""
+Asyncio entrypoint serving the same API as flask_app without a thread per
+request. Database work runs on unit_of_work.DEFAULT_EXECUTOR, sized to the
+connection pool. Run it with any ASGI server, e.g.
+
+    uvicorn app.entrypoints.asgi_app:app
+"""
+
+import asyncio
+import json
+from dataclasses import asdict
+from datetime import datetime
+from app import views
+from app.bootstrap import bootstrap
+from app.domain import model
+from app.service_layer import async_services, services, retries
+from app.adapters import unit_of_work
+
+uow_factory = unit_of_work.AsyncSqlAlchemyUnitOfWork
+routes = {}
+# Routes ending in a <parameter>, by method and the path before it.
+parameter_routes = {}
+
+
+def route(path, method):
+    def register(handler):
+        prefix, _, last = path.rpartition("/")
+        if last.startswith("<") and last.endswith(">"):
+            parameter_routes[(method, prefix)] = (handler, last[1:-1])
+        else:
+            routes[(method, path)] = handler
+        return handler
+
+    return register
+
+
+def find_route(method, path):
+    """The handler for a request and the path parameters to pass it."""
+    handler = routes.get((method, path))
+    if handler is not None:
+        return handler, {}
+    prefix, _, value = path.rpartition("/")
+    handler, name = parameter_routes.get((method, prefix), (None, None))
+    if handler is None or not value:
+        return None, {}
+    return handler, {name: value}
+
+
+@route("/health", "GET")
+async def health(body, headers):
+    return "OK", 200
+
+
+@route("/stats", "GET")
+async def stats(body, headers):
+    return {
+        "retries": retries.stats.snapshot(),
+        "product_cache": (
+            unit_of_work.DEFAULT_PRODUCT_CACHE.snapshot()
+            if unit_of_work.DEFAULT_PRODUCT_CACHE is not None
+            else None
+        ),
+    }, 200
+
+
+@route("/allocation", "POST")
+async def allocate(body, headers):
+    try:
+        batch_ref = await async_services.allocate(
+            orderid=body["orderid"],
+            sku=body["sku"],
+            qty=body["qty"],
+            uow=uow_factory(),
+            idempotency_key=headers.get("idempotency-key"),
+        )
+    except (model.OutOfStock, services.InvalidSku) as e:
+        return {"message": str(e)}, 400
+
+    return {"batchref": batch_ref}, 201
+
+
+@route("/allocations", "POST")
+async def allocate_many(body, headers):
+    results = await async_services.allocate_many(
+        lines=[(line["orderid"], line["sku"], line["qty"]) for line in body["lines"]],
+        uow=uow_factory(),
+    )
+    return {"results": [asdict(r) for r in results]}, 200
+
+
+@route("/orders/allocation", "POST")
+async def allocate_order(body, headers):
+    lines = [(line["sku"], line["qty"]) for line in body["lines"]]
+    try:
+        batch_refs = await async_services.allocate_order(
+            orderid=body["orderid"], lines=lines, uow=uow_factory()
+        )
+    except (model.OutOfStock, services.InvalidSku) as e:
+        return {"message": str(e)}, 400
+
+    return {
+        "lines": [
+            {"sku": sku, "qty": qty, "batchref": batch_ref}
+            for (sku, qty), batch_ref in zip(lines, batch_refs)
+        ]
+    }, 201
+
+
+@route("/allocations/<orderid>", "GET")
+async def allocations_view(body, headers, orderid):
+    result = await asyncio.get_running_loop().run_in_executor(
+        unit_of_work.DEFAULT_EXECUTOR,
+        views.allocations,
+        orderid,
+        unit_of_work.DEFAULT_ENGINE,
+    )
+    if not result:
+        return "not found", 404
+    return result, 200
+
+
+@route("/allocation", "DELETE")
+async def deallocate(body, headers):
+    await async_services.deallocate(
+        orderid=body["orderid"],
+        sku=body["sku"],
+        uow=uow_factory(),
+    )
+    return "OK", 204
+
+
+@route("/batch", "POST")
+async def add_batch(body, headers):
+    eta = body["eta"]
+    if eta is not None:
+        eta = datetime.fromisoformat(eta).date()
+    await async_services.add_batch(
+        batchref=body["batchref"],
+        sku=body["sku"],
+        qty=body["qty"],
+        eta=eta,
+        uow=uow_factory(),
+    )
+    return "OK", 201
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    handler, params = find_route(scope["method"], scope["path"])
+    if handler is None:
+        await respond(send, {"message": "Not found"}, 404)
+        return
+    body = await read_body(receive)
+    # ASGI header names are lowercase bytes.
+    headers = {
+        name.decode("latin-1"): value.decode("latin-1")
+        for name, value in scope.get("headers", [])
+    }
+    try:
+        payload, status = await handler(
+            json.loads(body) if body else None, headers, **params
+        )
+    except unit_of_work.ConcurrencyError:
+        payload, status = {"message": "Too much contention, try again"}, 409
+    await respond(send, payload, status)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.get_running_loop().run_in_executor(None, bootstrap)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def respond(send, payload, status):
+    if status == 204:
+        # A 204 response has no body, so none is sent whatever the handler
+        # returned.
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+        return
+    if isinstance(payload, str):
+        content_type, body = b"text/plain", payload.encode()
+    else:
+        content_type, body = b"application/json", json.dumps(payload).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type)],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -1,15 +1,45 @@
+import io
+import click
+from dataclasses import asdict
 from datetime import datetime
-from flask import Flask, request, jsonify
-from sqlalchemy import create_engine
-from app import config
-from app.adapters import orm
+from flask import Flask, Response, request, jsonify
+from app import config, instrumentation, simulation, views
+from app.bootstrap import bootstrap
+from app.adapters import batch_import, idempotency_repository, orm
 from app.domain import model
-from app.service_layer import services
+from app.service_layer import services, retries
+from app.service_layer.allocation_engine import AllocationEngine
 from app.adapters import unit_of_work
 
-orm.init(db_engine=create_engine(config.get_postgres_uri()))
+bootstrap()
 app = Flask(__name__)
 
+engine_settings = config.get_allocation_engine_settings()
+allocation_engine = (
+    AllocationEngine(unit_of_work.SqlAlchemyUnitOfWork, **engine_settings)
+    if engine_settings["shards"]
+    else None
+)
+
+
+if instrumentation.enabled or instrumentation.profile_sample_rate:
+
+    @app.before_request
+    def start_request_instrumentation():
+        instrumentation.start_request()
+
+    # Unlike after_request, teardown_request also runs when a view raises,
+    # so a sampled request never leaves its profiler running on the thread.
+    @app.teardown_request
+    def end_request_instrumentation(exception):
+        instrumentation.end_request(request.endpoint)
+
+
+def run_service(service, **kwargs):
+    if allocation_engine is not None:
+        return allocation_engine.submit(service, **kwargs).result()
+    return service(uow=unit_of_work.SqlAlchemyUnitOfWork(), **kwargs)
+
 
 def is_valid_sku(sku, batches):
     return sku in {b.sku for b in batches}
@@ -20,14 +50,42 @@ def health():
     return "OK", 200
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    return (
+        jsonify(
+            {
+                "retries": retries.stats.snapshot(),
+                "product_cache": (
+                    unit_of_work.DEFAULT_PRODUCT_CACHE.snapshot()
+                    if unit_of_work.DEFAULT_PRODUCT_CACHE is not None
+                    else None
+                ),
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(instrumentation.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.errorhandler(unit_of_work.ConcurrencyError)
+def concurrency_error(e):
+    return jsonify({"message": "Too much contention, try again"}), 409
+
+
 @app.route("/allocation", methods=["POST"])
 def allocate():
     try:
-        batch_ref = services.allocate(
+        batch_ref = run_service(
+            services.allocate,
             orderid=request.json["orderid"],
             sku=request.json["sku"],
             qty=request.json["qty"],
-            uow=unit_of_work.SqlAlchemyUnitOfWork(),
+            idempotency_key=request.headers.get("Idempotency-Key"),
         )
     except (model.OutOfStock, services.InvalidSku) as e:
         return jsonify({"message": str(e)}), 400
@@ -35,12 +93,73 @@ def allocate():
     return jsonify({"batchref": batch_ref}), 201
 
 
+@app.route("/allocations", methods=["POST"])
+def allocate_many():
+    results = services.allocate_many(
+        lines=[
+            (line["orderid"], line["sku"], line["qty"])
+            for line in request.json["lines"]
+        ],
+        uow=unit_of_work.SqlAlchemyUnitOfWork(),
+    )
+    return jsonify({"results": [asdict(r) for r in results]}), 200
+
+
+@app.route("/orders/allocation", methods=["POST"])
+def allocate_order():
+    lines = [(line["sku"], line["qty"]) for line in request.json["lines"]]
+    try:
+        batch_refs = services.allocate_order(
+            orderid=request.json["orderid"],
+            lines=lines,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(),
+        )
+    except (model.OutOfStock, services.InvalidSku) as e:
+        return jsonify({"message": str(e)}), 400
+
+    return (
+        jsonify(
+            {
+                "lines": [
+                    {"sku": sku, "qty": qty, "batchref": batch_ref}
+                    for (sku, qty), batch_ref in zip(lines, batch_refs)
+                ]
+            }
+        ),
+        201,
+    )
+
+
+@app.route("/allocations/<orderid>", methods=["GET"])
+def allocations_view(orderid):
+    result = views.allocations(orderid, unit_of_work.DEFAULT_ENGINE)
+    if not result:
+        return "not found", 404
+    return jsonify(result), 200
+
+
+@app.route("/simulations", methods=["POST"])
+def simulate():
+    scenarios = [
+        [(line["orderid"], line["sku"], line["qty"]) for line in scenario["lines"]]
+        for scenario in request.json["scenarios"]
+    ]
+    snapshots = simulation.load_snapshots(
+        unit_of_work.DEFAULT_ENGINE,
+        {sku for lines in scenarios for _, sku, _ in lines},
+    )
+    reports = simulation.simulate_many(
+        snapshots, scenarios, processes=config.get_simulation_processes()
+    )
+    return jsonify({"scenarios": [report.to_dict() for report in reports]}), 200
+
+
 @app.route("/allocation", methods=["DELETE"])
 def deallocate():
-    services.deallocate(
+    run_service(
+        services.deallocate,
         orderid=request.json["orderid"],
         sku=request.json["sku"],
-        uow=unit_of_work.SqlAlchemyUnitOfWork(),
     )
     return "OK", 204
 
@@ -49,12 +168,67 @@ def deallocate():
 def add_batch():
     eta = request.json["eta"]
     if eta is not None:
-        eta = datetime.fromisoformat(eta)
-    services.add_batch(
+        eta = datetime.fromisoformat(eta).date()
+    run_service(
+        services.add_batch,
         batchref=request.json["batchref"],
         sku=request.json["sku"],
         qty=request.json["qty"],
         eta=eta,
-        uow=unit_of_work.SqlAlchemyUnitOfWork(),
     )
     return "OK", 201
+
+
+@app.route("/batches/import", methods=["POST"])
+def import_batches():
+    format = request.args.get("format", "csv")
+    if format not in batch_import.FORMATS:
+        return jsonify({"message": f"Unknown import format: {format}"}), 400
+    report = batch_import.import_batches(
+        unit_of_work.DEFAULT_ENGINE,
+        # newline="" leaves line endings to the csv module, which needs them
+        # as they are to read quoted fields that span lines.
+        io.TextIOWrapper(request.stream, encoding="utf-8", newline=""),
+        format,
+        chunk_size=request.args.get("chunk_size", 1000, type=int),
+    )
+    return jsonify(report.to_dict()), 200
+
+
+@app.cli.command("import-batches")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", type=click.Choice(batch_import.FORMATS))
+@click.option("--chunk-size", default=1000, show_default=True)
+def import_batches_command(path, format, chunk_size):
+    """Load new batches from a CSV (with a header) or JSONL file."""
+    format = format or ("jsonl" if path.endswith(".jsonl") else "csv")
+    with open(path, newline="") as lines:
+        report = batch_import.import_batches(
+            unit_of_work.DEFAULT_ENGINE, lines, format, chunk_size
+        )
+    for error in report.errors:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(
+        f"{report.imported} of {report.rows} batches imported"
+        f" for {report.products} products in {report.seconds:.1f}s"
+        f" ({report.rows_per_sec:.0f} rows/s), {report.failed} failed"
+    )
+
+
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+    with unit_of_work.DEFAULT_ENGINE.begin() as connection:
+        purged = idempotency_repository.purge_expired_keys(
+            connection, config.get_idempotency_key_ttl()
+        )
+    click.echo(f"{purged} expired idempotency keys purged")
+
+
+@app.cli.command("reconcile-allocated-quantities")
+@click.option("--fix", is_flag=True, help="Overwrite mismatched totals.")
+def reconcile_allocated_quantities(fix):
+    with unit_of_work.DEFAULT_ENGINE.begin() as connection:
+        mismatches = orm.reconcile_allocated_quantities(connection, fix=fix)
+    for batch_ref, stored, actual in mismatches:
+        click.echo(f"{batch_ref}: stored {stored}, allocations sum to {actual}")
+    click.echo(f"{len(mismatches)} mismatched batches" + (" fixed" if fix else ""))
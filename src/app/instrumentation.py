@@ -0,0 +1,179 @@
+"""
+Optional timing of requests, allocation stages and SQL statements,
+exported in Prometheus text format, plus sampled cProfile dumps of whole
+requests. Until bootstrap turns it on, stage() hands back a shared no-op
+context manager and nothing else is hooked in, so the call sites can stay
+on the hot path.
+"""
+
+import contextlib
+import cProfile
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+enabled = False
+profile_sample_rate = 0.0
+profile_dir = "/tmp/allocation-profiles"
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * len(self.buckets) + [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series[-2]}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "allocation_stage_seconds", "Time spent in each stage of a request.", "stage"
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Time to handle a request.", "endpoint"
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "http_request_sql_statements",
+    "SQL statements executed per request.",
+    "endpoint",
+    buckets=COUNT_BUCKETS,
+)
+SQL_SECONDS = Histogram(
+    "sql_statement_seconds", "Time to execute a SQL statement.", "statement"
+)
+METRICS = [STAGE_SECONDS, REQUEST_SECONDS, REQUEST_SQL_STATEMENTS, SQL_SECONDS]
+
+_null_stage = contextlib.nullcontext()
+_local = threading.local()
+
+
+class RequestState:
+    """What is measured of one request while it runs."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.profiler: Optional[cProfile.Profile] = None
+
+
+def reset():
+    for metric in METRICS:
+        metric.reset()
+
+
+def render() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+def stage(name: str):
+    """Time the body of a with block as one stage of the current request."""
+    if not enabled:
+        return _null_stage
+    return _timed_stage(name)
+
+
+@contextlib.contextmanager
+def _timed_stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(name, time.perf_counter() - start)
+
+
+def instrument_engine(engine: Engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+    SQL_SECONDS.observe(statement.split(None, 1)[0].upper(), elapsed)
+    request = current_request()
+    if request is not None:
+        request.statements += 1
+
+
+def current_request() -> Optional[RequestState]:
+    """The request this thread is working on, if one was started or attached."""
+    return getattr(_local, "request", None)
+
+
+@contextlib.contextmanager
+def attach_request(request: Optional[RequestState]):
+    """
+    Count the SQL statements this thread runs in the with block towards a
+    request started on another thread, e.g. one waiting on a worker.
+    """
+    previous, _local.request = current_request(), request
+    try:
+        yield
+    finally:
+        _local.request = previous
+
+
+def start_request():
+    _local.request = request = RequestState()
+    if profile_sample_rate and random.random() < profile_sample_rate:
+        request.profiler = cProfile.Profile()
+        request.profiler.enable()
+
+
+def end_request(endpoint: Optional[str]) -> Optional[str]:
+    """Record the request started on this thread; returns the path of its profile, if any."""
+    request, _local.request = current_request(), None
+    if request is None:
+        return None
+    endpoint = endpoint or "unknown"
+    REQUEST_SECONDS.observe(endpoint, time.perf_counter() - request.started)
+    REQUEST_SQL_STATEMENTS.observe(endpoint, request.statements)
+    profiler = request.profiler
+    if profiler is None:
+        return None
+    profiler.disable()
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(
+        profile_dir, f"{endpoint}-{time.time():.6f}-{threading.get_ident()}.prof"
+    )
+    profiler.dump_stats(path)
+    return path
@@ -0,0 +1,180 @@
+"""
+Single-writer allocation: every SKU is owned by one worker thread, which
+runs the service functions for its SKUs one after another and commits them
+in groups. Products stay in each worker's ProductCache between groups, and
+since only the owner writes them within the process the cache keeps
+hitting. Other processes are still fenced off by the product version check.
+"""
+
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from app import instrumentation
+from app.adapters.product_cache import ProductCache
+from app.adapters.product_repository import AbstractProductRepository
+from app.adapters.unit_of_work import AbstractUnitOfWork, ConcurrencyError
+from app.domain import model
+from app.service_layer.retries import RetryPolicy, retry_on_conflict
+
+_STOP = object()
+
+
+@dataclass
+class _Request:
+    service: Callable
+    kwargs: dict
+    future: Future = field(default_factory=Future)
+    # The submitting thread's request, which the service's SQL counts towards.
+    instrumented: Optional[instrumentation.RequestState] = field(
+        default_factory=instrumentation.current_request
+    )
+
+
+class _GroupProductRepository(AbstractProductRepository):
+    def __init__(self, repository: AbstractProductRepository):
+        self._repository = repository
+        self._products = {}
+
+    def add(self, product: model.Product):
+        self._repository.add(product)
+        self._products[product.sku] = product
+
+    def get(self, sku: str) -> model.Product:
+        if self._products.get(sku) is None:
+            self._products[sku] = self._repository.get(sku)
+        return self._products[sku]
+
+    def forget(self):
+        self._products.clear()
+
+
+class _GroupUnitOfWork(AbstractUnitOfWork):
+    """
+    Runs service functions inside a group's open unit of work: products are
+    loaded once per group and their commits are deferred to the group's.
+    Each call runs in its own savepoint, so a call that fails, in the domain
+    or when its changes are written, takes only its own changes with it.
+    """
+
+    def __init__(self, uow: AbstractUnitOfWork):
+        self.products = _GroupProductRepository(uow.products)
+        self.idempotency_keys = uow.idempotency_keys
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class AllocationEngine:
+    def __init__(
+        self,
+        uow_factory: Callable[..., AbstractUnitOfWork],
+        shards: int = 4,
+        max_group_size: int = 100,
+        max_group_delay: float = 0.002,
+        product_cache_size: int = 1000,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        self._uow_factory = uow_factory
+        self.max_group_size = max_group_size
+        self.max_group_delay = max_group_delay
+        self.retry_policy = retry_policy
+        self._queues = [queue.Queue() for _ in range(shards)]
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(requests, ProductCache(product_cache_size)),
+                name=f"allocation-shard-{i}",
+                daemon=True,
+            )
+            for i, requests in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, service: Callable, sku: str, **kwargs) -> Future:
+        """
+        Queue a call of a service function, e.g. services.allocate, with the
+        SKU's owning worker. The future resolves once the call's group has
+        committed, with the service's return value or exception.
+        """
+        request = _Request(service, dict(sku=sku, **kwargs))
+        self._queues[self.shard_for(sku)].put(request)
+        return request.future
+
+    def shard_for(self, sku: str) -> int:
+        return zlib.crc32(sku.encode()) % len(self._queues)
+
+    def close(self):
+        for requests in self._queues:
+            requests.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, requests: queue.Queue, product_cache: ProductCache):
+        stopping = False
+        while not stopping:
+            group, stopping = self._next_group(requests)
+            if group:
+                self._apply(group, product_cache)
+
+    def _next_group(self, requests: queue.Queue):
+        request = requests.get()
+        if request is _STOP:
+            return [], True
+        group = [request]
+        deadline = time.monotonic() + self.max_group_delay
+        while len(group) < self.max_group_size:
+            try:
+                request = requests.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is _STOP:
+                return group, True
+            group.append(request)
+        return group, False
+
+    def _apply(self, group: List[_Request], product_cache: ProductCache):
+        try:
+            outcomes = retry_on_conflict(self._commit_group)(
+                group, product_cache, retry_policy=self.retry_policy
+            )
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+            return
+        for request, result, error in outcomes:
+            if error is None:
+                request.future.set_result(result)
+            else:
+                request.future.set_exception(error)
+
+    def _commit_group(self, group: List[_Request], product_cache: ProductCache):
+        outcomes = []
+        uow = self._uow_factory(product_cache=product_cache)
+        with uow:
+            shared = _GroupUnitOfWork(uow)
+            for request in group:
+                try:
+                    with uow.savepoint(), instrumentation.attach_request(
+                        request.instrumented
+                    ):
+                        result = request.service(uow=shared, **request.kwargs)
+                except ConcurrencyError:
+                    # The products are stale for the whole group: retry it.
+                    raise
+                except Exception as e:
+                    # Its products may have been rolled back; reload them.
+                    shared.products.forget()
+                    outcomes.append((request, None, e))
+                else:
+                    outcomes.append((request, result, None))
+            uow.commit()
+        return outcomes
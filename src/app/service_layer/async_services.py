@@ -0,0 +1,56 @@
+from datetime import date
+from typing import Optional, Sequence, Tuple
+from app.adapters import unit_of_work
+from app.service_layer import services
+
+# Async wrappers around the synchronous services. Each runs the whole use
+# case, retries included, in one hop off the event loop.
+
+
+async def allocate(
+    orderid: str,
+    sku: str,
+    qty: int,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+    idempotency_key: Optional[str] = None,
+) -> str:
+    return await uow.run_sync(
+        services.allocate,
+        orderid=orderid,
+        sku=sku,
+        qty=qty,
+        idempotency_key=idempotency_key,
+    )
+
+
+async def allocate_many(
+    lines: Sequence[Tuple[str, str, int]],
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+) -> list[services.AllocationResult]:
+    return await uow.run_sync(services.allocate_many, lines=lines)
+
+
+async def allocate_order(
+    orderid: str,
+    lines: Sequence[Tuple[str, int]],
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+) -> list[str]:
+    return await uow.run_sync(services.allocate_order, orderid=orderid, lines=lines)
+
+
+async def deallocate(
+    orderid: str,
+    sku: str,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    await uow.run_sync(services.deallocate, orderid=orderid, sku=sku)
+
+
+async def add_batch(
+    batchref: str,
+    sku: str,
+    qty: int,
+    eta: Optional[date],
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    await uow.run_sync(services.add_batch, batchref=batchref, sku=sku, qty=qty, eta=eta)
@@ -0,0 +1,72 @@
+import functools
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from app.adapters.unit_of_work import ConcurrencyError
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = 5
+    base_delay: float = 0.005
+    max_delay: float = 0.2
+
+    def backoff(self, retry: int) -> float:
+        """Full-jitter exponential backoff to sleep before the nth retry."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return random.uniform(0, ceiling)
+
+
+class RetryStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.conflicts = 0
+            self.retries = 0
+            self.exhausted = 0
+
+    def record(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "conflicts": self.conflicts,
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+            }
+
+
+DEFAULT_POLICY = RetryPolicy()
+stats = RetryStats()
+
+
+def retry_on_conflict(fn):
+    """
+    Re-run a service function when its unit of work loses a concurrent
+    update, up to the policy's number of attempts. The function must open
+    its own unit of work so each attempt starts a fresh transaction.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, retry_policy: Optional[RetryPolicy] = None, **kwargs):
+        policy = retry_policy or DEFAULT_POLICY
+        for attempt in range(1, policy.attempts + 1):
+            try:
+                return fn(*args, **kwargs)
+            except ConcurrencyError:
+                stats.record("conflicts")
+                if attempt == policy.attempts:
+                    stats.record("exhausted")
+                    raise
+                stats.record("retries")
+                time.sleep(policy.backoff(attempt))
+
+    return wrapper
@@ -1,33 +1,123 @@
+from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import Optional, Sequence, Tuple
+from app import instrumentation
 from app.domain import model
 from app.adapters import unit_of_work
+from app.service_layer.retries import retry_on_conflict
 
 
 class InvalidSku(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class AllocationResult:
+    orderid: str
+    sku: str
+    qty: int
+    batchref: Optional[str] = None
+    error: Optional[str] = None
+
+
 def is_valid_sku(sku, batches):
     return sku in {b.sku for b in batches}
 
 
+@retry_on_conflict
 def allocate(
     orderid: str,
     sku: str,
     qty: int,
     uow: unit_of_work.AbstractUnitOfWork,
+    idempotency_key: Optional[str] = None,
 ):
+    """
+    Allocate a line and return the batch reference. A request repeating an
+    earlier one's idempotency_key gets that request's batch reference back
+    without loading the product.
+    """
     line = model.OrderLine(orderid=orderid, sku=sku, qty=qty)
     with uow:
-        product = uow.products.get(sku=sku)
+        if idempotency_key is not None:
+            batch_ref = uow.idempotency_keys.get(idempotency_key)
+            if batch_ref is not None:
+                return batch_ref
+        with instrumentation.stage("products_get"):
+            product = uow.products.get_for_allocation(sku=sku)
         if product is None:
             raise InvalidSku(f"Invalid sku: {sku}")
-        batch_ref = product.allocate(line)
+        with instrumentation.stage("allocate"):
+            batch_ref = product.allocate(line)
+        if idempotency_key is not None:
+            uow.idempotency_keys.add(idempotency_key, batch_ref)
         uow.commit()
     return batch_ref
 
 
+@retry_on_conflict
+def allocate_many(
+    lines: Sequence[Tuple[str, str, int]],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> list[AllocationResult]:
+    """
+    Allocate (orderid, sku, qty) lines in order, loading each product once,
+    allocating its lines as one wave and committing them all together. A
+    line that cannot be allocated gets an error result instead of failing
+    the others.
+    """
+    results = [None] * len(lines)
+    waves = {}
+    for i, (orderid, sku, qty) in enumerate(lines):
+        waves.setdefault(sku, []).append((i, model.OrderLine(orderid, sku, qty)))
+    with uow:
+        for sku, wave in waves.items():
+            product = uow.products.get_for_allocation(sku=sku)
+            if product is None:
+                outcomes = [InvalidSku(f"Invalid sku: {sku}")] * len(wave)
+            else:
+                outcomes = product.allocate_many([line for _, line in wave])
+            for (i, line), outcome in zip(wave, outcomes):
+                if isinstance(outcome, Exception):
+                    result = AllocationResult(
+                        line.orderid, sku, line.qty, error=str(outcome)
+                    )
+                else:
+                    result = AllocationResult(
+                        line.orderid, sku, line.qty, batchref=outcome
+                    )
+                results[i] = result
+        uow.commit()
+    return results
+
+
+@retry_on_conflict
+def allocate_order(
+    orderid: str,
+    lines: Sequence[Tuple[str, int]],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> list[str]:
+    """
+    Allocate every (sku, qty) line of an order in one unit of work and
+    return their batch references in the same order. All or nothing: an
+    unknown sku raises InvalidSku, a line that doesn't fit raises
+    OutOfStock, and either way nothing is committed. Products are loaded
+    in sku order so that orders sharing skus take their locks in the same
+    order.
+    """
+    order_lines = [model.OrderLine(orderid, sku, qty) for sku, qty in lines]
+    with uow:
+        products = {}
+        for sku in sorted({line.sku for line in order_lines}):
+            products[sku] = uow.products.get_for_allocation(sku=sku)
+            if products[sku] is None:
+                raise InvalidSku(f"Invalid sku: {sku}")
+        batch_refs = [products[line.sku].allocate(line) for line in order_lines]
+        uow.commit()
+    return batch_refs
+
+
+@retry_on_conflict
 def deallocate(
     orderid: str,
     sku: str,
@@ -40,6 +130,7 @@ def deallocate(
             uow.commit()
 
 
+@retry_on_conflict
 def add_batch(
     batchref: str,
     sku: str,
@@ -48,7 +139,7 @@ def add_batch(
     uow: unit_of_work.AbstractUnitOfWork,
 ):
     with uow:
-        product = uow.products.get(sku=sku)
+        product = uow.products.get_for_allocation(sku=sku)
         if product is None:
             product = model.Product(sku, batches=[])
             uow.products.add(product)
@@ -0,0 +1,20 @@
+"""
+Queries for the read side. They go straight to the allocations_view read
+model with Core SQL, so reads neither load aggregates nor go through the
+mappers.
+"""
+
+from typing import List
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connectable
+
+from app.adapters.orm import allocations_view
+
+
+def allocations(orderid: str, db: Connectable) -> List[dict]:
+    view = allocations_view.c
+    rows = db.execute(
+        select([view.sku, view.batchref, view.qty]).where(view.orderid == orderid)
+    )
+    return [dict(sku=sku, batchref=batchref, qty=qty) for sku, batchref, qty in rows]
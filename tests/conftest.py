@@ -4,6 +4,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from sqlalchemy.exc import OperationalError
 from app.adapters.orm import metadata, start_mappers, wait_for_db
+from app.domain import model
 from app import config
 
 
@@ -18,6 +19,11 @@ def wait_for_webapp_to_come_up():
     pytest.fail("API never came up")
 
 
+@pytest.fixture(autouse=True)
+def check_allocated_quantity(monkeypatch):
+    monkeypatch.setattr(model, "CHECK_ALLOCATED_QUANTITY", True)
+
+
 @pytest.fixture
 def in_memory_db():
     engine = create_engine("sqlite:///:memory:")
@@ -77,3 +77,137 @@ def test_deallocate():
     r4 = requests.post(f"{url}/allocation", json=orderline2)
     assert r4.status_code == 201
     assert r4.json()["batchref"] == batchref
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_many_returns_a_result_per_line():
+    sku, batchref = random_sku(), random_batchref()
+    orderid1, orderid2 = random_orderid(), random_orderid()
+    add_batch(batchref, sku, 10, today)
+    lines = [
+        {"orderid": orderid1, "sku": sku, "qty": 10},
+        {"orderid": orderid2, "sku": sku, "qty": 10},
+    ]
+    url = config.get_api_url()
+
+    r = requests.post(f"{url}/allocations", json={"lines": lines})
+
+    assert r.status_code == 200
+    [first, second] = r.json()["results"]
+    assert first["batchref"] == batchref
+    assert second["error"] == f"Out of stock for sku: {sku}"
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_get_allocations_for_an_order():
+    sku1, sku2 = random_sku(), random_sku()
+    batch1, batch2 = random_batchref(), random_batchref()
+    orderid = random_orderid()
+    add_batch(batch1, sku1, 100, today)
+    add_batch(batch2, sku2, 100, today)
+    url = config.get_api_url()
+    for sku in (sku1, sku2):
+        data = {"orderid": orderid, "sku": sku, "qty": 3}
+        assert requests.post(f"{url}/allocation", json=data).status_code == 201
+
+    r = requests.get(f"{url}/allocations/{orderid}")
+
+    assert r.status_code == 200
+    assert sorted(r.json(), key=lambda row: row["batchref"]) == sorted(
+        [
+            {"sku": sku1, "batchref": batch1, "qty": 3},
+            {"sku": sku2, "batchref": batch2, "qty": 3},
+        ],
+        key=lambda row: row["batchref"],
+    )
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_get_allocations_for_unknown_order_returns_404():
+    url = config.get_api_url()
+    r = requests.get(f"{url}/allocations/{random_orderid()}")
+    assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_retry_with_idempotency_key_returns_same_batchref():
+    sku, batch1, batch2 = random_sku(), random_batchref(), random_batchref()
+    add_batch(batch1, sku, 10, today)
+    add_batch(batch2, sku, 10, tomorrow)
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    url = config.get_api_url()
+    headers = {"Idempotency-Key": random_orderid("key")}
+
+    first = requests.post(f"{url}/allocation", json=data, headers=headers)
+    retry = requests.post(f"{url}/allocation", json=data, headers=headers)
+
+    assert first.status_code == retry.status_code == 201
+    assert first.json()["batchref"] == retry.json()["batchref"] == batch1
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_simulation_reports_depletion_without_allocating():
+    sku, batch = random_sku(), random_batchref()
+    add_batch(batch, sku, 10, today)
+    url = config.get_api_url()
+    lines = [{"orderid": random_orderid(), "sku": sku, "qty": 5} for _ in range(3)]
+
+    r = requests.post(f"{url}/simulations", json={"scenarios": [{"lines": lines}]})
+
+    assert r.status_code == 200
+    [report] = r.json()["scenarios"]
+    assert (report["allocated"], report["out_of_stock"]) == (2, 1)
+    assert report["batches"][0]["depleted_by"] == lines[1]["orderid"]
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    assert requests.post(f"{url}/allocation", json=data).json()["batchref"] == batch
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_order_allocates_every_line_or_none():
+    sku1, sku2 = random_sku(), random_sku()
+    batch1, batch2 = random_batchref(), random_batchref()
+    add_batch(batch1, sku1, 10, today)
+    add_batch(batch2, sku2, 10, today)
+    url = config.get_api_url()
+    orderid = random_orderid()
+
+    too_much = [{"sku": sku1, "qty": 5}, {"sku": sku2, "qty": 20}]
+    r = requests.post(
+        f"{url}/orders/allocation", json={"orderid": orderid, "lines": too_much}
+    )
+    assert r.status_code == 400
+    assert r.json()["message"] == f"Out of stock for sku: {sku2}"
+
+    lines = [{"sku": sku1, "qty": 10}, {"sku": sku2, "qty": 10}]
+    r = requests.post(
+        f"{url}/orders/allocation", json={"orderid": orderid, "lines": lines}
+    )
+    assert r.status_code == 201
+    assert r.json()["lines"] == [
+        {"sku": sku1, "qty": 10, "batchref": batch1},
+        {"sku": sku2, "qty": 10, "batchref": batch2},
+    ]
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_import_batches_from_csv_reports_rows_and_errors():
+    sku = random_sku()
+    batch1, batch2, batch3 = random_batchref(), random_batchref(), random_batchref()
+    body = (
+        "batchref,sku,qty,eta,notes\r\n"
+        f'{batch1},{sku},10,,"arrives\r\nin two parts"\r\n'
+        f"{batch2},{sku},0,,\r\n"
+        f"{batch3},{sku},5,{later},\r\n"
+    )
+    url = config.get_api_url()
+
+    r = requests.post(
+        f"{url}/batches/import", data=body.encode(), params={"format": "csv"}
+    )
+
+    assert r.status_code == 200
+    report = r.json()
+    assert (report["rows"], report["imported"], report["failed"]) == (3, 2, 1)
+    assert report["errors"] == [{"line": 4, "error": "invalid qty: '0'"}]
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    assert requests.post(f"{url}/allocation", json=data).json()["batchref"] == batch1
@@ -0,0 +1,61 @@
+import pytest
+
+from app.adapters import batch_import, unit_of_work
+from app.service_layer import services
+
+CSV = """batchref,sku,qty,eta
+b1,LAMP,100,
+b2,LAMP,50,2030-01-31
+b3,CHAIR,10,
+b4,CHAIR,-1,
+b5,,10,
+b6,TABLE,5,soon
+b1,TABLE,5,
+"""
+
+
+def test_imports_valid_rows_and_reports_the_rest(in_memory_db, session_factory):
+    report = batch_import.import_batches(in_memory_db, CSV.splitlines(), "csv")
+
+    assert (report.rows, report.imported, report.failed) == (7, 3, 4)
+    assert report.products == 2
+    assert report.errors == [
+        {"line": 5, "error": "invalid qty: '-1'"},
+        {"line": 6, "error": "missing sku"},
+        {"line": 7, "error": "invalid eta: 'soon'"},
+        {"line": 8, "error": "batch b1 already exists"},
+    ]
+    rows = in_memory_db.execute("SELECT batch_ref, sku, initial_quantity FROM batches")
+    assert sorted(rows) == [
+        ("b1", "LAMP", 100),
+        ("b2", "LAMP", 50),
+        ("b3", "CHAIR", 10),
+    ]
+
+
+def test_imports_jsonl_in_chunks_and_bumps_product_versions(
+    in_memory_db, session_factory
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=None)
+    services.add_batch("existing", "LAMP", 10, None, uow=uow)
+    lines = [
+        f'{{"batchref": "b{i}", "sku": "LAMP", "qty": 5, "eta": null}}'
+        for i in range(5)
+    ] + ["not json"]
+
+    report = batch_import.import_batches(in_memory_db, lines, "jsonl", chunk_size=2)
+
+    assert (report.rows, report.imported, report.failed) == (6, 5, 1)
+    assert report.errors == [{"line": 6, "error": "not a JSON object"}]
+    [[version_number]] = in_memory_db.execute(
+        "SELECT version_number FROM products WHERE sku = 'LAMP'"
+    )
+    assert version_number == 1 + 3
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=None)
+    with uow:
+        assert len(uow.products.get("LAMP").batches) == 6
+
+
+def test_unknown_format_is_rejected(in_memory_db):
+    with pytest.raises(ValueError, match="Unknown import format"):
+        batch_import.import_batches(in_memory_db, [], "xml")
@@ -0,0 +1,83 @@
+from sqlalchemy import event
+
+from app.adapters import idempotency_repository, unit_of_work
+from app.service_layer import services
+from tests.helpers import random_sku, random_orderid
+
+
+def test_repeated_key_returns_batchref_without_loading_product(
+    in_memory_db, session_factory
+):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku, orderid = random_sku(), random_orderid()
+    services.add_batch("b1", sku, 10, None, uow=uow())
+    assert services.allocate(orderid, sku, 10, uow=uow(), idempotency_key="k1") == "b1"
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(in_memory_db, "before_cursor_execute", record)
+
+    batchref = services.allocate(orderid, sku, 10, uow=uow(), idempotency_key="k1")
+
+    event.remove(in_memory_db, "before_cursor_execute", record)
+    assert batchref == "b1"
+    assert len(statements) == 1 and "idempotency_keys" in statements[0]
+
+
+class RacedUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    """Another allocation commits just after the first product load."""
+
+    def __init__(self, session_factory, sku):
+        super().__init__(session_factory)
+        self.race = lambda: services.allocate(
+            "racing-order",
+            sku,
+            10,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        )
+
+    def __enter__(self):
+        super().__enter__()
+        get_for_allocation = self.products.get_for_allocation
+
+        def get_then_race(*args, **kwargs):
+            product = get_for_allocation(*args, **kwargs)
+            if self.race is not None:
+                race, self.race = self.race, None
+                race()
+            return product
+
+        self.products.get_for_allocation = get_then_race
+
+
+def test_allocation_with_key_is_retried_when_it_loses_a_race(
+    in_memory_db, session_factory
+):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku, orderid = random_sku(), random_orderid()
+    services.add_batch("b1", sku, 100, None, uow=uow())
+
+    raced = RacedUnitOfWork(session_factory, sku)
+    assert services.allocate(orderid, sku, 10, uow=raced, idempotency_key="k1") == "b1"
+
+    assert services.allocate(orderid, sku, 10, uow=uow(), idempotency_key="k1") == "b1"
+    [[allocated]] = in_memory_db.execute("SELECT allocated_quantity FROM batches")
+    assert allocated == 20
+
+
+def test_expired_keys_are_ignored_reused_and_purged(in_memory_db, session_factory):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku = random_sku()
+    services.add_batch("b1", sku, 100, None, uow=uow())
+    services.allocate("o1", sku, 10, uow=uow(), idempotency_key="k1")
+    services.allocate("o2", sku, 10, uow=uow(), idempotency_key="k2")
+    in_memory_db.execute(
+        "UPDATE idempotency_keys SET created_at = created_at - 100000 WHERE key = 'k1'"
+    )
+
+    services.allocate("o3", sku, 10, uow=uow(), idempotency_key="k1")
+    in_memory_db.execute("UPDATE idempotency_keys SET created_at = created_at - 100000")
+
+    with in_memory_db.begin() as connection:
+        assert idempotency_repository.purge_expired_keys(connection, ttl=3600) == 2
+    [[allocated]] = in_memory_db.execute("SELECT allocated_quantity FROM batches")
+    assert allocated == 30
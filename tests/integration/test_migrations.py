@@ -0,0 +1,80 @@
+from datetime import date
+
+from sqlalchemy import create_engine, inspect, select
+
+from app.adapters import migrations, orm
+
+OLD_BATCHES = (
+    "CREATE TABLE batches ("
+    " id INTEGER PRIMARY KEY, batch_ref VARCHAR(255) NOT NULL,"
+    " sku VARCHAR(255) NOT NULL, initial_quantity INTEGER NOT NULL,"
+    " eta VARCHAR(255))"
+)
+
+
+def test_migrate_adds_and_backfills_batches_allocated_quantity():
+    engine = create_engine("sqlite:///:memory:")
+    engine.execute(OLD_BATCHES)
+    orm.metadata.create_all(engine)
+    engine.execute(
+        "INSERT INTO batches (id, batch_ref, sku, initial_quantity)"
+        " VALUES (1, 'batch1', 'LAMP', 100), (2, 'batch2', 'LAMP', 100)"
+    )
+    engine.execute(
+        "INSERT INTO order_lines (id, orderid, sku, qty)"
+        " VALUES (1, 'order1', 'LAMP', 10), (2, 'order2', 'LAMP', 5)"
+    )
+    engine.execute(
+        "INSERT INTO allocations (orderline_id, batch_id) VALUES (1, 1), (2, 1)"
+    )
+
+    migrations.migrate(engine)
+    migrations.migrate(engine)
+
+    rows = list(engine.execute("SELECT batch_ref, allocated_quantity FROM batches"))
+    assert rows == [("batch1", 15), ("batch2", 0)]
+
+
+def test_migrate_creates_missing_indexes():
+    engine = create_engine("sqlite:///:memory:")
+    orm.metadata.create_all(engine)
+    engine.execute("DROP INDEX ix_batches_sku_eta")
+    engine.execute("DROP INDEX ix_allocations_batch_id")
+
+    migrations.migrate(engine)
+    migrations.migrate(engine)
+
+    indexes = {
+        index["name"]
+        for table in ("batches", "allocations")
+        for index in inspect(engine).get_indexes(table)
+    }
+    assert {"ix_batches_sku_eta", "ix_allocations_batch_id"} <= indexes
+
+
+def test_migrate_converts_string_etas_to_dates():
+    engine = create_engine("sqlite:///:memory:")
+    engine.execute(OLD_BATCHES)
+    engine.execute("CREATE INDEX ix_batches_sku ON batches (sku)")
+    orm.metadata.create_all(engine)
+    engine.execute(
+        "INSERT INTO batches (batch_ref, sku, initial_quantity, eta) VALUES"
+        " ('in-stock', 'LAMP', 10, NULL), ('blank', 'LAMP', 10, ''),"
+        " ('date', 'LAMP', 10, '2020-01-02'),"
+        " ('datetime', 'LAMP', 10, '2020-01-03 00:00:00')"
+    )
+
+    migrations.migrate(engine)
+    migrations.migrate(engine)
+
+    batches = orm.batches.c
+    rows = engine.execute(select([batches.batch_ref, batches.eta]).order_by(batches.id))
+    assert list(rows) == [
+        ("in-stock", None),
+        ("blank", None),
+        ("date", date(2020, 1, 2)),
+        ("datetime", date(2020, 1, 3)),
+    ]
+    indexes = {index["name"] for index in inspect(engine).get_indexes("batches")}
+    assert "ix_batches_sku" not in indexes
+    assert "ix_batches_sku_eta" in indexes
@@ -1,6 +1,7 @@
 import pytest
 from datetime import date
 
+from app.adapters.orm import reconcile_allocated_quantities
 from app.domain.model import OrderLine, Batch, Product
 
 
@@ -111,3 +112,64 @@ def test_product_mapper_can_save_products(session):
 
     rows = list(session.execute("SELECT sku FROM products"))
     assert rows == [("BLUE-PLATE",)]
+
+
+def test_batch_mapper_saves_allocated_quantity(session):
+    batch = Batch(batch_ref="batch1", sku="DECORATIVE-TRINKET", qty=20)
+    session.add(batch)
+    batch.allocate(OrderLine(orderid="order1", sku="DECORATIVE-TRINKET", qty=2))
+    batch.allocate(OrderLine(orderid="order2", sku="DECORATIVE-TRINKET", qty=3))
+    session.commit()
+    batch.deallocate("order1", "DECORATIVE-TRINKET")
+    session.commit()
+
+    rows = list(session.execute("SELECT batch_ref, allocated_quantity FROM batches"))
+    assert rows == [("batch1", 3)]
+
+
+def test_batch_mapper_loads_allocated_quantity(session):
+    session.execute(
+        "INSERT INTO batches (batch_ref, sku, initial_quantity, allocated_quantity)"
+        " VALUES ('batch1', 'LAMP', 100, 0), ('batch2', 'LAMP', 100, 0)"
+    )
+
+    batches = session.query(Batch).order_by(Batch.batch_ref).all()
+
+    assert [b.available_quantity for b in batches] == [100, 100]
+
+
+def test_reconcile_reports_and_fixes_allocated_quantities(session):
+    batch = Batch(batch_ref="batch1", sku="DECORATIVE-TRINKET", qty=20)
+    session.add(batch)
+    batch.allocate(OrderLine(orderid="order1", sku="DECORATIVE-TRINKET", qty=2))
+    session.add(Batch(batch_ref="batch2", sku="DECORATIVE-TRINKET", qty=20))
+    session.commit()
+    session.execute("UPDATE batches SET allocated_quantity = 7")
+    connection = session.connection()
+
+    assert reconcile_allocated_quantities(connection) == [
+        ("batch1", 7, 2),
+        ("batch2", 7, 0),
+    ]
+    assert reconcile_allocated_quantities(connection, fix=True) != []
+    assert reconcile_allocated_quantities(connection) == []
+    rows = list(session.execute("SELECT allocated_quantity FROM batches"))
+    assert rows == [(2,), (0,)]
+
+
+def test_reconcile_fix_bumps_the_version_of_affected_products(session):
+    session.execute(
+        "INSERT INTO products (sku, version_number) VALUES"
+        " ('MISCOUNTED', 3), ('FINE', 3)"
+    )
+    session.add(Batch(batch_ref="batch1", sku="MISCOUNTED", qty=20))
+    session.add(Batch(batch_ref="batch2", sku="FINE", qty=20))
+    session.commit()
+    session.execute(
+        "UPDATE batches SET allocated_quantity = 7 WHERE sku = 'MISCOUNTED'"
+    )
+
+    reconcile_allocated_quantities(session.connection(), fix=True)
+
+    rows = list(session.execute("SELECT sku, version_number FROM products"))
+    assert sorted(rows) == [("FINE", 3), ("MISCOUNTED", 4)]
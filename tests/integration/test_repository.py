@@ -0,0 +1,285 @@
+import pytest
+from datetime import date
+from sqlalchemy import event
+
+from app.adapters import unit_of_work
+from app.adapters.product_cache import ProductCache
+from app.adapters.product_repository import SqlAlchemyProductRepository
+from app.domain import model
+from app.service_layer import services
+from tests.helpers import random_sku
+
+
+def add_product(session_factory, sku, batches, lines_per_batch):
+    session = session_factory()
+    product = model.Product(sku, batches=[])
+    for i in range(batches):
+        product.add_batch(model.Batch(f"{sku}-batch{i}", sku, lines_per_batch))
+    for i in range(batches * lines_per_batch):
+        product.allocate(model.OrderLine(f"order{i}", sku, 1))
+    session.add(product)
+    session.commit()
+
+
+@pytest.fixture
+def statements(in_memory_db):
+    executed = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement.split()[0])
+
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    yield executed
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+
+@pytest.mark.parametrize(
+    "loading, expected_selects",
+    [("lazy", 1 + 1 + 5), ("selectin", 3), ("joined", 1), ("single", 1)],
+)
+def test_allocation_statement_count(
+    session_factory, statements, loading, expected_selects
+):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=5, lines_per_batch=3)
+    statements.clear()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading=loading)
+    with uow:
+        product = uow.products.get(sku)
+        product.add_batch(model.Batch("new-batch", sku, 10))
+        product.allocate(model.OrderLine("new-order", sku, 10))
+        uow.commit()
+
+    assert statements == ["SELECT"] * expected_selects + [
+        "UPDATE",  # products.version_number
+        "INSERT",  # batches
+        "INSERT",  # order_lines
+        "INSERT",  # allocations
+        "INSERT",  # allocations_view
+    ]
+
+
+@pytest.mark.parametrize("loading", ["lazy", "selectin", "joined", "single"])
+def test_loading_strategies_load_the_same_product(session_factory, loading):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=3, lines_per_batch=2)
+    add_product(session_factory, random_sku(), batches=2, lines_per_batch=2)
+
+    product = SqlAlchemyProductRepository(session_factory(), loading).get(sku)
+
+    assert product.sku == sku
+    assert len(product.batches) == 3
+    assert all(b.allocated_quantity == 2 for b in product.batches)
+    assert {line.orderid for b in product.batches for line in b._allocations} == {
+        f"order{i}" for i in range(6)
+    }
+
+
+def test_get_returns_none_for_unknown_sku(session):
+    for loading in ["lazy", "selectin", "joined", "single"]:
+        assert SqlAlchemyProductRepository(session, loading).get("NOPE") is None
+
+
+def test_rejects_unknown_loading_strategy(session):
+    with pytest.raises(ValueError):
+        SqlAlchemyProductRepository(session, "eager")
+
+
+def test_get_batchref_with_capacity_follows_allocation_order(session):
+    sku = random_sku()
+    product = model.Product(sku, batches=[])
+    product.add_batch(model.Batch("later", sku, 100, eta=date(2020, 1, 3)))
+    product.add_batch(model.Batch("sooner", sku, 10, eta=date(2020, 1, 2)))
+    product.add_batch(model.Batch("in-stock", sku, 5, eta=None))
+    product.allocate(model.OrderLine("order1", sku, 3))
+    session.add(product)
+    session.commit()
+    repo = SqlAlchemyProductRepository(session)
+
+    assert repo.get_batchref_with_capacity(sku, 2) == "in-stock"
+    assert repo.get_batchref_with_capacity(sku, 3) == "sooner"
+    assert repo.get_batchref_with_capacity(sku, 50) == "later"
+    assert repo.get_batchref_with_capacity(sku, 500) is None
+
+
+def test_write_only_allocation_does_not_load_order_lines(session_factory, statements):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=2, lines_per_batch=3)
+    statements.clear()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, write_only_allocations=True
+    )
+    with uow:
+        product = uow.products.get_for_allocation(sku)
+        product.add_batch(model.Batch("new-batch", sku, 10))
+        assert product.allocate(model.OrderLine("new-order", sku, 10)) == "new-batch"
+        assert all(not b._allocations for b in product.batches[:2])
+        uow.commit()
+
+    assert statements[:2] == ["SELECT", "SELECT"]
+    assert "SELECT" not in statements[2:]
+    with uow:
+        product = uow.products.get(sku)
+        assert [b.allocated_quantity for b in product.batches] == [3, 3, 10]
+        assert {b.batch_ref for b in product.batches if b.has_orderid("new-order")} == {
+            "new-batch"
+        }
+
+
+def test_write_only_allocation_keeps_deallocation_working(session_factory):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=1, lines_per_batch=3)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, write_only_allocations=True
+    )
+
+    services.deallocate("order0", sku, uow=uow)
+    services.allocate("order-new", sku, 1, uow=uow)
+    services.deallocate("order1", sku, uow=uow)
+
+    with uow:
+        [batch] = uow.products.get(sku).batches
+        assert batch.orderids == {"order2", "order-new"}
+        assert batch.allocated_quantity == 2
+
+
+def query_plan(engine, statement, params):
+    return " / ".join(
+        row[-1] for row in engine.execute(f"EXPLAIN QUERY PLAN {statement}", params)
+    )
+
+
+@pytest.mark.parametrize("write_only_allocations", [False, True])
+def test_product_lookups_use_indexes(
+    in_memory_db, session_factory, write_only_allocations
+):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=3, lines_per_batch=2)
+    selects = []
+
+    def record(conn, cursor, statement, params, *args):
+        if statement.startswith("SELECT"):
+            selects.append((statement, params))
+
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    repo = SqlAlchemyProductRepository(
+        session_factory(), write_only_allocations=write_only_allocations
+    )
+    repo.get_for_allocation(sku)
+    repo.get_batchref_with_capacity(sku, 1)
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+    plans = [query_plan(in_memory_db, *select) for select in selects]
+    assert plans
+    for plan in plans:
+        assert "SCAN" not in plan, plan
+
+
+def test_order_line_lookup_by_orderid_and_sku_uses_index(in_memory_db):
+    plan = query_plan(
+        in_memory_db,
+        "SELECT batch_id FROM order_lines JOIN allocations"
+        " ON allocations.orderline_id = order_lines.id"
+        " WHERE order_lines.orderid = ? AND order_lines.sku = ?",
+        ("order1", "sku1"),
+    )
+
+    assert "ix_order_lines_orderid_sku" in plan
+    assert "ix_allocations_orderline_id" in plan
+
+
+@pytest.fixture
+def product_cache():
+    return ProductCache(max_size=10)
+
+
+def test_cached_product_is_reused_without_reloading(
+    session_factory, statements, product_cache
+):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=3, lines_per_batch=2)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=product_cache
+    )
+    services.add_batch(f"{sku}-extra", sku, 10, eta=None, uow=uow)
+    services.allocate("order-a", sku, 1, uow=uow)
+    statements.clear()
+
+    assert services.allocate("order-b", sku, 5, uow=uow) == f"{sku}-extra"
+
+    assert statements.count("SELECT") == 1
+    assert product_cache.snapshot()["hits"] == 2
+    with uow:
+        product = uow.products.get(sku)
+        assert {b.batch_ref: b.allocated_quantity for b in product.batches} == {
+            f"{sku}-batch0": 2,
+            f"{sku}-batch1": 2,
+            f"{sku}-batch2": 2,
+            f"{sku}-extra": 6,
+        }
+    uncached = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uncached:
+        product = uncached.products.get(sku)
+        assert {b.batch_ref: b.allocated_quantity for b in product.batches} == {
+            f"{sku}-batch0": 2,
+            f"{sku}-batch1": 2,
+            f"{sku}-batch2": 2,
+            f"{sku}-extra": 6,
+        }
+
+
+def test_cached_product_is_reloaded_after_a_write_elsewhere(
+    session_factory, product_cache
+):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=1, lines_per_batch=2)
+    cached = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=product_cache
+    )
+    uncached = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.deallocate("order0", sku, uow=cached)
+    services.allocate("order-elsewhere", sku, 1, uow=uncached)
+
+    with pytest.raises(model.OutOfStock):
+        services.allocate("order-here", sku, 1, uow=cached)
+
+    assert product_cache.snapshot()["stale"] == 1
+
+
+def test_uncommitted_product_is_not_cached(session_factory, product_cache):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=1, lines_per_batch=2)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=product_cache
+    )
+    services.deallocate("order0", sku, uow=uow)
+
+    with uow:
+        uow.products.get(sku).allocate(model.OrderLine("order-x", sku, 1))
+
+    assert len(product_cache) == 0
+    with uow:
+        [batch] = uow.products.get(sku).batches
+        assert batch.orderids == {"order1"}
+
+
+def test_version_conflict_invalidates_cached_product(session_factory, product_cache):
+    sku = random_sku()
+    add_product(session_factory, sku, batches=1, lines_per_batch=2)
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=product_cache
+    )
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.deallocate("order0", sku, uow=uow1)
+
+    with uow1:
+        uow1.products.get(sku).deallocate("order1", sku)
+        with uow2:
+            uow2.products.get(sku).allocate(model.OrderLine("order-x", sku, 1))
+            uow2.commit()
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            uow1.commit()
+
+    assert len(product_cache) == 0
@@ -0,0 +1,112 @@
+from datetime import date
+
+from sqlalchemy import event
+
+from app import simulation
+from app.adapters import unit_of_work
+from app.service_layer import services
+from tests.helpers import random_sku
+
+
+def seed(session_factory, sku):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch("in-stock", sku, 10, None, uow=uow())
+    services.add_batch("shipment", sku, 20, date(2030, 1, 1), uow=uow())
+    services.allocate("existing-order", sku, 4, uow=uow())
+
+
+def test_reports_which_line_depletes_each_batch(in_memory_db, session_factory):
+    sku = random_sku()
+    seed(session_factory, sku)
+    snapshots = simulation.load_snapshots(in_memory_db, [sku])
+
+    report = simulation.simulate(
+        snapshots,
+        [("o1", sku, 5), ("o2", sku, 1), ("o3", sku, 20), ("o4", sku, 1)],
+    )
+
+    assert report.to_dict() == {
+        "lines": 4,
+        "allocated": 3,
+        "out_of_stock": 1,
+        "invalid_sku": 0,
+        "batches": [
+            {
+                "batchref": "in-stock",
+                "sku": sku,
+                "available_before": 6,
+                "allocated": 6,
+                "available_after": 0,
+                "depleted_at": 1,
+                "depleted_by": "o2",
+            },
+            {
+                "batchref": "shipment",
+                "sku": sku,
+                "available_before": 20,
+                "allocated": 20,
+                "available_after": 0,
+                "depleted_at": 2,
+                "depleted_by": "o3",
+            },
+        ],
+    }
+
+
+def test_a_repeated_line_takes_no_more_stock(in_memory_db, session_factory):
+    sku = random_sku()
+    seed(session_factory, sku)
+    snapshots = simulation.load_snapshots(in_memory_db, [sku])
+
+    report = simulation.simulate(snapshots, [("o1", sku, 3), ("o1", sku, 3)])
+
+    in_stock = report.batches[0].to_dict()
+    assert in_stock["allocated"] == 3
+    assert in_stock["available_after"] == 3
+    assert in_stock["depleted_at"] is None
+
+
+def test_counts_lines_for_unknown_skus(in_memory_db, session_factory):
+    sku = random_sku()
+    seed(session_factory, sku)
+    snapshots = simulation.load_snapshots(in_memory_db, [sku, "NOPE"])
+
+    report = simulation.simulate(snapshots, [("o1", "NOPE", 1), ("o2", sku, 1)])
+
+    assert (report.allocated, report.invalid_sku) == (1, 1)
+
+
+def test_simulation_only_reads(in_memory_db, session_factory):
+    sku = random_sku()
+    seed(session_factory, sku)
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    try:
+        snapshots = simulation.load_snapshots(in_memory_db, [sku])
+        simulation.simulate(snapshots, [("o1", sku, 6), ("o2", sku, 20)])
+    finally:
+        event.remove(in_memory_db, "before_cursor_execute", record)
+
+    assert [s.split(None, 1)[0].upper() for s in statements] == ["SELECT"]
+    later = simulation.simulate(
+        simulation.load_snapshots(in_memory_db, [sku]), [("o3", sku, 6)]
+    )
+    assert later.batches[0].available_before == 6
+
+
+def test_scenarios_in_a_process_pool_match_running_them_here(
+    in_memory_db, session_factory
+):
+    sku = random_sku()
+    seed(session_factory, sku)
+    snapshots = simulation.load_snapshots(in_memory_db, [sku])
+    scenarios = [
+        [(f"o{i}", sku, qty) for i in range(n)] for n, qty in [(3, 2), (10, 3), (1, 30)]
+    ]
+
+    pooled = simulation.simulate_many(snapshots, scenarios, processes=2)
+
+    assert [r.to_dict() for r in pooled] == [
+        r.to_dict() for r in simulation.simulate_many(snapshots, scenarios, processes=1)
+    ]
@@ -1,9 +1,16 @@
-import pytest, time, traceback, threading
+import pytest, time, traceback, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
 from psycopg2.errors import SerializationFailure
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, clear_mappers
 from app.adapters import unit_of_work
+from app.adapters.group_commit import GroupCommitter
+from app.adapters.orm import metadata, start_mappers
+from app.service_layer import async_services, services
+from app.service_layer.allocation_engine import AllocationEngine
 from app.domain import model
 from tests.helpers import random_batchref, random_sku, random_orderid
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 
 def insert_product(session, sku, version_number=1):
@@ -42,6 +49,11 @@ def insert_allocation(session, orderline_id, batch_id):
         "INSERT INTO allocations (orderline_id, batch_id) VALUES (:orderline_id, :batch_id)",
         dict(orderline_id=orderline_id, batch_id=batch_id),
     )
+    session.execute(
+        "UPDATE batches SET allocated_quantity = allocated_quantity"
+        " + (SELECT qty FROM order_lines WHERE id=:orderline_id) WHERE id=:batch_id",
+        dict(orderline_id=orderline_id, batch_id=batch_id),
+    )
 
 
 def get_allocated_batch_ref(session, orderid, sku):
@@ -144,6 +156,27 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
+def test_allocate_order_rolls_back_every_line_if_one_fails(session_factory):
+    sku1, sku2 = random_sku(), random_sku()
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch("b1", sku1, 10, None, uow=uow())
+    services.add_batch("b2", sku2, 10, None, uow=uow())
+
+    with pytest.raises(model.OutOfStock):
+        services.allocate_order("o1", [(sku1, 10), (sku2, 20)], uow=uow())
+
+    session = session_factory()
+    assert list(session.execute("SELECT * FROM allocations")) == []
+    assert list(session.execute("SELECT allocated_quantity FROM batches")) == [
+        (0,),
+        (0,),
+    ]
+    assert services.allocate_order("o1", [(sku1, 10), (sku2, 10)], uow=uow()) == [
+        "b1",
+        "b2",
+    ]
+
+
 def test_can_add_batch_to_product(session_factory):
     sku = random_sku()
     session = session_factory()
@@ -165,6 +198,29 @@ def test_can_add_batch_to_product(session_factory):
     assert rows == [("batch1", sku, 100, None)]
 
 
+def test_commit_raises_concurrency_error_on_stale_product_version(session_factory):
+    sku = random_sku()
+    session = session_factory()
+    insert_product(session, sku, version_number=1)
+    insert_batch(session, random_batchref(), sku, 100, None)
+    session.commit()
+
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow1:
+        uow1.products.get(sku).allocate(model.OrderLine("order1", sku, 10))
+        with uow2:
+            uow2.products.get(sku).allocate(model.OrderLine("order2", sku, 10))
+            uow1.commit()
+            with pytest.raises(unit_of_work.ConcurrencyError):
+                uow2.commit()
+
+    [[version_number]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku", dict(sku=sku)
+    )
+    assert version_number == 2
+
+
 def try_to_allocate_slowly(orderid, sku, exceptions):
     line = model.OrderLine(orderid, sku, 10)
     uow = unit_of_work.SqlAlchemyUnitOfWork()
@@ -214,3 +270,315 @@ def test_concurrent_allocations_are_not_allowed(psql_session_factory):
         )
     )
     assert len(allocations) == 1
+
+
+@pytest.fixture
+def threadsafe_session_factory(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'db.sqlite'}",
+        connect_args={"check_same_thread": False},
+    )
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def test_async_uow_can_allocate_line_to_a_batch(threadsafe_session_factory):
+    sku, batch_ref = random_sku(), random_batchref()
+    session = threadsafe_session_factory()
+    insert_product(session, sku)
+    insert_batch(session, batch_ref, sku, 100, None)
+    session.commit()
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    async def allocate():
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(
+            threadsafe_session_factory, executor
+        )
+        async with uow:
+            product = await uow.products.get(sku)
+            product.allocate(model.OrderLine("order1", sku, 10))
+            await uow.commit()
+
+    asyncio.run(allocate())
+
+    assert get_allocated_batch_ref(session, "order1", sku) == batch_ref
+
+
+def test_async_uow_rolls_back_uncommitted_work(threadsafe_session_factory):
+    sku = random_sku()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    async def add_product():
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(
+            threadsafe_session_factory, executor
+        )
+        async with uow:
+            uow.products.add(model.Product(sku, batches=[]))
+
+    asyncio.run(add_product())
+
+    rows = list(threadsafe_session_factory().execute("SELECT * FROM products"))
+    assert rows == []
+
+
+def test_async_services_run_on_async_uow(threadsafe_session_factory):
+    sku = random_sku()
+    # SQLite doesn't hold one snapshot across a session's queries, so keep
+    # the database work on one thread while the requests run concurrently.
+    executor = ThreadPoolExecutor(max_workers=1)
+    uow = lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(
+        threadsafe_session_factory, executor
+    )
+
+    async def allocate_concurrently():
+        await async_services.add_batch("batch1", sku, 100, eta=None, uow=uow())
+        return await asyncio.gather(
+            *(
+                async_services.allocate(f"order{i}", sku, 10, uow=uow())
+                for i in range(10)
+            )
+        )
+
+    results = asyncio.run(allocate_concurrently())
+
+    assert results == ["batch1"] * 10
+    [[allocated_quantity]] = threadsafe_session_factory().execute(
+        "SELECT allocated_quantity FROM batches"
+    )
+    assert allocated_quantity == 100
+
+
+def test_allocation_engine_group_commits_to_the_database(threadsafe_session_factory):
+    skus = [random_sku() for _ in range(3)]
+    engine = AllocationEngine(
+        lambda product_cache: unit_of_work.SqlAlchemyUnitOfWork(
+            threadsafe_session_factory, product_cache=product_cache
+        ),
+        shards=1,
+    )
+    try:
+        for sku in skus:
+            engine.submit(
+                services.add_batch, sku, batchref=f"{sku}-b", qty=100, eta=None
+            )
+        futures = [
+            engine.submit(services.allocate, sku, orderid=f"order{i}", qty=10)
+            for i in range(10)
+            for sku in skus
+        ]
+        assert [f.result() for f in futures] == [f"{sku}-b" for sku in skus] * 10
+    finally:
+        engine.close()
+
+    session = threadsafe_session_factory()
+    rows = session.execute("SELECT batch_ref, allocated_quantity FROM batches")
+    assert sorted(rows) == sorted((f"{sku}-b", 100) for sku in skus)
+    [[allocations]] = session.execute("SELECT count(*) FROM allocations")
+    assert allocations == 30
+
+
+def test_allocation_engine_fails_only_the_failing_request(threadsafe_session_factory):
+    sku, other_sku = random_sku(), random_sku()
+    uow = lambda **kwargs: unit_of_work.SqlAlchemyUnitOfWork(
+        threadsafe_session_factory, **kwargs
+    )
+    services.add_batch("taken", sku, 100, None, uow=uow())
+    services.add_batch("other", other_sku, 10, None, uow=uow())
+
+    def allocate_then_fail(sku, uow):
+        with uow:
+            uow.products.get(sku).allocate(model.OrderLine("doomed", sku, 5))
+            raise RuntimeError("after changing the product")
+
+    engine = AllocationEngine(
+        lambda product_cache: uow(product_cache=product_cache),
+        shards=1,
+        max_group_size=4,
+        max_group_delay=5,
+    )
+    try:
+        futures = [
+            engine.submit(services.add_batch, sku, batchref="taken", qty=1, eta=None),
+            engine.submit(services.allocate, other_sku, orderid="o1", qty=5),
+            engine.submit(allocate_then_fail, other_sku),
+            engine.submit(services.allocate, other_sku, orderid="o2", qty=5),
+        ]
+        with pytest.raises(IntegrityError):
+            futures[0].result()
+        assert futures[1].result() == "other"
+        with pytest.raises(RuntimeError):
+            futures[2].result()
+        assert futures[3].result() == "other"
+    finally:
+        engine.close()
+
+    session = threadsafe_session_factory()
+    rows = session.execute("SELECT batch_ref, allocated_quantity FROM batches")
+    assert sorted(rows) == [("other", 10), ("taken", 0)]
+    orders = session.execute("SELECT orderid FROM order_lines ORDER BY orderid")
+    assert list(orders) == [("o1",), ("o2",)]
+
+
+@pytest.fixture
+def group_committer_factory(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'group.sqlite'}",
+        connect_args={"check_same_thread": False},
+    )
+    metadata.create_all(engine)
+    start_mappers()
+    yield engine, sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def test_group_commit_shares_one_commit_between_units_of_work(
+    group_committer_factory,
+):
+    engine, session_factory = group_committer_factory
+    committer = GroupCommitter(engine, max_size=5, max_delay=5)
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(conn))
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=None, group_committer=committer
+    )
+    skus = [random_sku() for _ in range(5)]
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        list(
+            executor.map(
+                lambda sku: services.add_batch(f"{sku}-b", sku, 10, None, uow=uow()),
+                skus,
+            )
+        )
+
+    assert len(commits) == 1
+    rows = engine.execute("SELECT sku, version_number FROM products")
+    assert sorted(rows) == sorted((sku, 1) for sku in skus)
+
+
+def test_group_commit_fails_only_the_failing_unit_of_work(group_committer_factory):
+    engine, session_factory = group_committer_factory
+    sku = random_sku()
+    # Members read concurrently, so they would all try to create the product.
+    services.add_batch(
+        "b0",
+        sku,
+        10,
+        None,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, product_cache=None, group_committer=None
+        ),
+    )
+    committer = GroupCommitter(engine, max_size=3, max_delay=0.05)
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=None, group_committer=committer
+    )
+
+    def add_batch(ref):
+        return services.add_batch(ref, sku, 10, None, uow=uow())
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(add_batch, ref) for ref in ["b1", "b1", "b2", "b3"]]
+        errors = [f.exception() for f in futures if f.exception()]
+
+    assert [type(e) for e in errors] == [IntegrityError]
+    rows = engine.execute("SELECT batch_ref FROM batches ORDER BY batch_ref")
+    assert [r for [r] in rows] == ["b0", "b1", "b2", "b3"]
+
+
+def test_group_members_read_while_another_holds_the_turn(group_committer_factory):
+    engine, session_factory = group_committer_factory
+    sku, new_sku = random_sku(), random_sku()
+    services.add_batch(
+        "b1",
+        sku,
+        10,
+        None,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, product_cache=None, group_committer=None
+        ),
+    )
+    committer = GroupCommitter(engine, max_size=5, max_delay=0.01)
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=None, group_committer=committer
+    )
+    writing, read = threading.Event(), threading.Event()
+
+    def write():
+        writer = uow()
+        with writer:
+            writer.products.add(model.Product(new_sku, batches=[]))
+            writer.flush()
+            writing.set()
+            assert read.wait(timeout=5)
+            writer.commit()
+
+    def read_while_writing():
+        assert writing.wait(timeout=5)
+        reader = uow()
+        with reader:
+            batchrefs = [b.batch_ref for b in reader.products.get(sku).batches]
+        read.set()
+        return batchrefs
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        written = executor.submit(write)
+        assert executor.submit(read_while_writing).result(timeout=5) == ["b1"]
+        written.result(timeout=5)
+    rows = engine.execute("SELECT sku FROM products ORDER BY sku")
+    assert sorted(r for [r] in rows) == sorted([sku, new_sku])
+
+
+def test_unit_of_work_opened_during_a_turn_commits_on_its_own(
+    group_committer_factory,
+):
+    engine, session_factory = group_committer_factory
+    sku = random_sku()
+    committer = GroupCommitter(engine, max_size=5, max_delay=0.01)
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=None, group_committer=committer
+    )
+
+    def nested():
+        outer, inner = uow(), uow()
+        with outer:
+            with inner:
+                return inner.products.get(sku)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(nested).result(timeout=5) is None
+        services.add_batch("b1", sku, 10, None, uow=uow())
+    assert not committer.has_turn()
+
+
+def test_group_commit_on_postgres(postgres_db, psql_session_factory):
+    committer = GroupCommitter(postgres_db, max_size=8, max_delay=0.5)
+    commits = []
+    count_commit = lambda conn: commits.append(conn)
+    event.listen(postgres_db, "commit", count_commit)
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        psql_session_factory, product_cache=None, group_committer=committer
+    )
+    skus = [random_sku() for _ in range(8)]
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(
+                executor.map(
+                    lambda sku: services.add_batch(
+                        f"{sku}-b", sku, 10, None, uow=uow()
+                    ),
+                    skus,
+                )
+            )
+    finally:
+        event.remove(postgres_db, "commit", count_commit)
+
+    assert len(commits) < len(skus)
+    session = psql_session_factory()
+    rows = session.execute(
+        "SELECT sku, version_number FROM products WHERE sku IN :skus",
+        dict(skus=tuple(skus)),
+    )
+    assert sorted(rows) == sorted((sku, 1) for sku in skus)
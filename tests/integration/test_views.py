@@ -0,0 +1,101 @@
+from sqlalchemy import event
+
+from app import views
+from app.adapters import migrations, unit_of_work
+from app.service_layer import services
+from tests.helpers import random_sku, random_orderid
+from tests.integration.test_repository import query_plan
+
+
+def allocations(orderid, engine):
+    return sorted(views.allocations(orderid, engine), key=lambda row: row["sku"])
+
+
+def test_allocations_view(in_memory_db, session_factory):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku1, sku2 = sorted([random_sku(), random_sku()])
+    orderid = random_orderid()
+    services.add_batch("sku1batch", sku1, 50, None, uow=uow())
+    services.add_batch("sku2batch", sku2, 50, None, uow=uow())
+    services.allocate(orderid, sku1, 20, uow=uow())
+    services.allocate(orderid, sku2, 20, uow=uow())
+    services.allocate("other-order", sku1, 30, uow=uow())
+
+    assert allocations(orderid, in_memory_db) == [
+        {"sku": sku1, "batchref": "sku1batch", "qty": 20},
+        {"sku": sku2, "batchref": "sku2batch", "qty": 20},
+    ]
+
+
+def test_deallocation_removes_line_from_view(in_memory_db, session_factory):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku, orderid = random_sku(), random_orderid()
+    services.add_batch("b1", sku, 50, None, uow=uow())
+    services.allocate(orderid, sku, 20, uow=uow())
+
+    services.deallocate(orderid, sku, uow=uow())
+
+    assert views.allocations(orderid, in_memory_db) == []
+
+
+def test_deallocating_one_of_two_lines_in_a_batch_keeps_the_other_in_view(
+    in_memory_db, session_factory
+):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku, orderid = random_sku(), random_orderid()
+    services.add_batch("b1", sku, 50, None, uow=uow())
+    services.allocate(orderid, sku, 1, uow=uow())
+    services.allocate(orderid, sku, 2, uow=uow())
+
+    services.deallocate(orderid, sku, uow=uow())
+
+    [row] = views.allocations(orderid, in_memory_db)
+    assert row["batchref"] == "b1"
+    assert row["qty"] in (1, 2)
+
+
+def test_write_only_allocations_update_the_view(in_memory_db, session_factory):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, write_only_allocations=True
+    )
+    sku, orderid = random_sku(), random_orderid()
+    services.add_batch("b1", sku, 50, None, uow=uow())
+    services.allocate("earlier-order", sku, 5, uow=uow())
+
+    services.allocate(orderid, sku, 20, uow=uow())
+
+    assert views.allocations(orderid, in_memory_db) == [
+        {"sku": sku, "batchref": "b1", "qty": 20}
+    ]
+
+
+def test_migrate_fills_an_empty_view_from_allocations(in_memory_db, session_factory):
+    uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    sku, orderid = random_sku(), random_orderid()
+    services.add_batch("b1", sku, 50, None, uow=uow())
+    services.allocate(orderid, sku, 20, uow=uow())
+    in_memory_db.execute("DELETE FROM allocations_view")
+
+    migrations.migrate(in_memory_db)
+    migrations.migrate(in_memory_db)
+
+    assert views.allocations(orderid, in_memory_db) == [
+        {"sku": sku, "batchref": "b1", "qty": 20}
+    ]
+
+
+def test_allocations_view_query_uses_orderid_index(in_memory_db):
+    statements = []
+    event.listen(
+        in_memory_db,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, params, *args: statements.append(
+            (statement, params)
+        ),
+    )
+    views.allocations("order1", in_memory_db)
+
+    [(statement, params)] = statements
+    assert "ix_allocations_view_orderid_sku" in query_plan(
+        in_memory_db, statement, params
+    )
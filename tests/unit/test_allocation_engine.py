@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+
+from app import instrumentation
+from app.domain import model
+from app.service_layer import services
+from app.service_layer.allocation_engine import AllocationEngine
+from tests.helpers import random_sku
+from tests.unit.test_services import ConflictingUnitOfWork, no_backoff
+
+
+@pytest.fixture
+def uow():
+    return ConflictingUnitOfWork(conflicts=0)
+
+
+def start_engine(uow, **kwargs):
+    kwargs.setdefault("shards", 1)
+    kwargs.setdefault("retry_policy", no_backoff)
+    return AllocationEngine(lambda product_cache: uow, **kwargs)
+
+
+def test_engine_runs_services_and_resolves_each_callers_result(uow):
+    sku = random_sku()
+    engine = start_engine(uow)
+    try:
+        engine.submit(services.add_batch, sku, batchref="b1", qty=10, eta=None).result()
+        assert (
+            engine.submit(services.allocate, sku, orderid="o1", qty=10).result() == "b1"
+        )
+        with pytest.raises(model.OutOfStock):
+            engine.submit(services.allocate, sku, orderid="o2", qty=1).result()
+        engine.submit(services.deallocate, sku, orderid="o1").result()
+        assert (
+            engine.submit(services.allocate, sku, orderid="o2", qty=1).result() == "b1"
+        )
+    finally:
+        engine.close()
+
+
+def test_engine_commits_queued_requests_together(uow):
+    sku = random_sku()
+    services.add_batch("b1", sku, 5, eta=None, uow=uow)
+    uow.commits = 0
+    engine = start_engine(uow, max_group_size=10, max_group_delay=5)
+    try:
+        futures = [
+            engine.submit(services.allocate, sku, orderid=f"o{i}", qty=1)
+            for i in range(10)
+        ]
+        outcomes = [f.exception() or f.result() for f in futures]
+    finally:
+        engine.close()
+
+    assert outcomes[:5] == ["b1"] * 5
+    assert all(isinstance(e, model.OutOfStock) for e in outcomes[5:])
+    assert uow.commits == 1
+
+
+def test_engine_retries_a_group_that_loses_a_concurrent_update(uow):
+    sku = random_sku()
+    services.add_batch("b1", sku, 10, eta=None, uow=uow)
+    uow.conflicts, uow.commits = 1, 0
+    engine = start_engine(uow)
+    try:
+        assert (
+            engine.submit(services.allocate, sku, orderid="o1", qty=1).result() == "b1"
+        )
+    finally:
+        engine.close()
+
+    assert uow.commits == 2
+
+
+def test_each_sku_is_handled_by_one_worker(uow):
+    def worker(sku, uow):
+        return threading.current_thread().name
+
+    skus = [random_sku() for _ in range(20)]
+    engine = start_engine(uow, shards=4)
+    try:
+        futures = [(sku, engine.submit(worker, sku)) for sku in skus * 5]
+        workers = {}
+        for sku, future in futures:
+            workers.setdefault(sku, set()).add(future.result())
+    finally:
+        engine.close()
+
+    assert all(
+        names == {f"allocation-shard-{engine.shard_for(sku)}"}
+        for sku, names in workers.items()
+    )
+
+
+def test_engine_runs_services_in_the_submitting_threads_request(uow):
+    seen = []
+    record = lambda sku, uow: seen.append(instrumentation.current_request())
+    engine = start_engine(uow)
+    instrumentation.start_request()
+    request = instrumentation.current_request()
+    try:
+        engine.submit(record, random_sku()).result()
+    finally:
+        instrumentation.end_request("allocate")
+        engine.close()
+
+    assert seen == [request]
@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+
+from app.adapters import unit_of_work
+from app.adapters.orm import allocations_view, metadata
+from app.entrypoints import asgi_app
+from app.service_layer import async_services, services
+from tests.helpers import random_sku, random_orderid
+from tests.unit.test_services import FakeUnitOfWork2
+
+
+class FakeAsyncUnitOfWork(unit_of_work.AbstractAsyncUnitOfWork):
+    def __init__(self, uow=None):
+        self.sync_uow = uow or FakeUnitOfWork2()
+        self.products = None
+
+    async def commit(self):
+        self.sync_uow.commit()
+
+    async def rollback(self):
+        pass
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return fn(*args, uow=self.sync_uow, **kwargs)
+
+
+def test_async_services_run_the_sync_use_cases():
+    sku, orderid = random_sku(), random_orderid()
+    uow = FakeAsyncUnitOfWork()
+
+    async def scenario():
+        await async_services.add_batch("b1", sku, 10, eta=None, uow=uow)
+        assert await async_services.allocate(orderid, sku, 10, uow=uow) == "b1"
+        with pytest.raises(services.InvalidSku):
+            await async_services.allocate(orderid, "NOPE", 10, uow=uow)
+        await async_services.deallocate(orderid, sku, uow=uow)
+        return await async_services.allocate_many([("o2", sku, 10)], uow=uow)
+
+    [result] = asyncio.run(scenario())
+
+    assert result.batchref == "b1"
+    assert uow.sync_uow.committed
+
+
+def call_asgi(method, path, body=None, headers=()):
+    messages = [{"type": "http.request", "body": json.dumps(body).encode()}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+    }
+    asyncio.run(asgi_app.app(scope, receive, send))
+    start, response = sent
+    content = response["body"].decode()
+    if dict(start["headers"]).get(b"content-type") == b"application/json":
+        content = json.loads(content)
+    return start["status"], content
+
+
+@pytest.fixture
+def fake_asgi_uow(monkeypatch):
+    uow = FakeAsyncUnitOfWork()
+    monkeypatch.setattr(asgi_app, "uow_factory", lambda: uow)
+    return uow
+
+
+@pytest.mark.usefixtures("fake_asgi_uow")
+def test_asgi_app_allocates_and_deallocates():
+    sku, orderid = random_sku(), random_orderid()
+    batch = {"batchref": "b1", "sku": sku, "qty": 10, "eta": "2011-11-04"}
+    line = {"orderid": orderid, "sku": sku, "qty": 10}
+
+    assert call_asgi("POST", "/batch", batch) == (201, "OK")
+    assert call_asgi("POST", "/allocation", line) == (201, {"batchref": "b1"})
+    assert call_asgi("POST", "/allocation", {**line, "orderid": "o2"}) == (
+        400,
+        {"message": f"Out of stock for sku: {sku}"},
+    )
+    assert call_asgi("DELETE", "/allocation", line) == (204, "")
+    assert call_asgi("POST", "/allocation", line) == (201, {"batchref": "b1"})
+
+
+@pytest.mark.usefixtures("fake_asgi_uow")
+def test_asgi_app_allocates_whole_orders():
+    sku1, sku2 = random_sku(), random_sku()
+    for batchref, sku in [("b1", sku1), ("b2", sku2)]:
+        batch = {"batchref": batchref, "sku": sku, "qty": 10, "eta": None}
+        assert call_asgi("POST", "/batch", batch) == (201, "OK")
+    order = {"orderid": random_orderid(), "lines": [{"sku": sku1, "qty": 10}]}
+
+    assert call_asgi("POST", "/orders/allocation", order) == (
+        201,
+        {"lines": [{"sku": sku1, "qty": 10, "batchref": "b1"}]},
+    )
+    order["lines"].append({"sku": "NOPE", "qty": 1})
+    assert call_asgi("POST", "/orders/allocation", order) == (
+        400,
+        {"message": "Invalid sku: NOPE"},
+    )
+
+
+@pytest.mark.usefixtures("fake_asgi_uow")
+def test_asgi_app_passes_the_idempotency_key_header():
+    sku = random_sku()
+    batch = {"batchref": "b1", "sku": sku, "qty": 10, "eta": None}
+    line = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    headers = [("Idempotency-Key", "k1")]
+    call_asgi("POST", "/batch", batch)
+
+    assert call_asgi("POST", "/allocation", line, headers) == (201, {"batchref": "b1"})
+    assert call_asgi("POST", "/allocation", line, headers) == (201, {"batchref": "b1"})
+
+
+@pytest.mark.usefixtures("fake_asgi_uow")
+def test_asgi_app_returns_404_for_unknown_routes():
+    assert call_asgi("GET", "/nowhere")[0] == 404
+
+
+def test_asgi_app_serves_the_allocations_view(monkeypatch):
+    # One shared connection, as the view is read on an executor thread.
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    metadata.create_all(engine)
+    engine.execute(
+        allocations_view.insert(), orderid="o1", sku="LAMP", batchref="b1", qty=3
+    )
+    monkeypatch.setattr(unit_of_work, "DEFAULT_ENGINE", engine)
+
+    assert call_asgi("GET", "/allocations/o1") == (
+        200,
+        [{"sku": "LAMP", "batchref": "b1", "qty": 3}],
+    )
+    assert call_asgi("GET", "/allocations/o2") == (404, "not found")
@@ -1,6 +1,6 @@
 import pytest
 
-from app.domain.model import Batch, OrderLine
+from app.domain.model import AllocationsNotLoaded, Batch, OrderLine
 
 
 def make_batch_and_line(sku, batch_qty, line_qty):
@@ -72,3 +72,60 @@ def test_can_only_dealocate_allocated_lines():
     batch.deallocate(unallocated_line.orderid, unallocated_line.sku)
 
     assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_tracks_allocations_and_deallocations():
+    batch = Batch(batch_ref="batch-001", sku="ELEGANT-LAMP", qty=20)
+
+    batch.allocate(OrderLine(orderid="order-1", sku="ELEGANT-LAMP", qty=2))
+    batch.allocate(OrderLine(orderid="order-2", sku="ELEGANT-LAMP", qty=5))
+    batch.deallocate("order-1", "ELEGANT-LAMP")
+
+    assert batch.allocated_quantity == 5
+
+
+def test_allocated_quantity_check_catches_out_of_sync_total():
+    batch, line = make_batch_and_line(sku="ELEGANT-LAMP", batch_qty=20, line_qty=2)
+    batch._allocations.add(line)
+
+    with pytest.raises(AssertionError, match="batch-001"):
+        batch.allocated_quantity
+
+
+def test_batch_with_unloaded_allocations_can_still_allocate():
+    batch, line = make_batch_and_line(sku="ELEGANT-LAMP", batch_qty=20, line_qty=2)
+    batch.allocate(line)
+    batch.mark_allocations_unloaded()
+
+    batch.allocate(OrderLine(orderid="order-456", sku="ELEGANT-LAMP", qty=5))
+
+    assert batch.available_quantity == 13
+
+
+def test_batch_with_unloaded_allocations_cannot_deallocate():
+    batch, line = make_batch_and_line(sku="ELEGANT-LAMP", batch_qty=20, line_qty=2)
+    batch.allocate(line)
+    batch.mark_allocations_unloaded()
+
+    with pytest.raises(AllocationsNotLoaded, match="batch-001"):
+        batch.deallocate(line.orderid, line.sku)
+
+
+def test_can_deallocate_each_line_of_an_order_allocated_to_one_batch():
+    batch = Batch(batch_ref="batch-001", sku="ELEGANT-LAMP", qty=20)
+    batch.allocate(OrderLine(orderid="order-1", sku="ELEGANT-LAMP", qty=2))
+    batch.allocate(OrderLine(orderid="order-1", sku="ELEGANT-LAMP", qty=5))
+
+    batch.deallocate("order-1", "ELEGANT-LAMP")
+    assert batch.orderids == {"order-1"}
+    batch.deallocate("order-1", "ELEGANT-LAMP")
+
+    assert batch.orderids == set()
+    assert batch.allocated_quantity == 0
+
+
+def test_order_lines_share_one_sku_string():
+    sku = "".join(["ELEGANT-", "LAMP"])
+    line = OrderLine(orderid="order-1", sku=sku, qty=2)
+
+    assert line.sku is OrderLine(orderid="order-2", sku="ELEGANT-LAMP", qty=1).sku
@@ -0,0 +1,29 @@
+from app import config
+
+
+def test_engine_options_default_to_pooled_repeatable_read():
+    options = config.get_engine_options()
+
+    assert options["pool_size"] == 5
+    assert options["max_overflow"] == 10
+    assert options["pool_pre_ping"] is True
+    assert options["isolation_level"] == "REPEATABLE READ"
+    assert "connect_args" not in options
+
+
+def test_engine_options_are_read_from_the_environment(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "0")
+    monkeypatch.setenv("DB_POOL_RECYCLE", "60")
+    monkeypatch.setenv("DB_ISOLATION_LEVEL", "READ COMMITTED")
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "2500")
+
+    assert config.get_engine_options() == dict(
+        pool_size=20,
+        max_overflow=0,
+        pool_pre_ping=False,
+        pool_recycle=60,
+        isolation_level="READ COMMITTED",
+        connect_args={"options": "-c statement_timeout=2500"},
+    )
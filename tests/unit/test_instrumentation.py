@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from app import instrumentation
+from app.service_layer import services
+from tests.helpers import random_sku
+from tests.unit.test_services import FakeUnitOfWork2
+
+
+@pytest.fixture
+def instrumented(monkeypatch):
+    monkeypatch.setattr(instrumentation, "enabled", True)
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+
+
+def test_stages_are_shared_no_ops_when_disabled():
+    instrumentation.reset()
+
+    with instrumentation.stage("commit"):
+        pass
+
+    assert instrumentation.stage("commit") is instrumentation.stage("allocate")
+    assert "allocation_stage_seconds_count" not in instrumentation.render()
+
+
+def test_allocate_records_its_stages(instrumented):
+    sku = random_sku()
+    uow = FakeUnitOfWork2()
+    services.add_batch("b1", sku, 10, eta=None, uow=uow)
+
+    services.allocate("o1", sku, 1, uow=uow)
+
+    metrics = instrumentation.render()
+    assert 'allocation_stage_seconds_count{stage="products_get"} 1' in metrics
+    assert 'allocation_stage_seconds_count{stage="allocate"} 1' in metrics
+
+
+def test_histograms_render_cumulative_prometheus_buckets():
+    histogram = instrumentation.Histogram(
+        "things", "Things seen.", "kind", buckets=(1, 5)
+    )
+    for value in [0.5, 3, 3, 9]:
+        histogram.observe("a", value)
+
+    assert histogram.render() == [
+        "# HELP things Things seen.",
+        "# TYPE things histogram",
+        'things_bucket{kind="a",le="1"} 1',
+        'things_bucket{kind="a",le="5"} 3',
+        'things_bucket{kind="a",le="+Inf"} 4',
+        'things_sum{kind="a"} 15.5',
+        'things_count{kind="a"} 4',
+    ]
+
+
+def test_requests_count_their_sql_statements(instrumented):
+    engine = create_engine("sqlite:///:memory:")
+    instrumentation.instrument_engine(engine)
+
+    instrumentation.start_request()
+    engine.execute("SELECT 1")
+    engine.execute("SELECT 2")
+    instrumentation.end_request("allocate")
+
+    metrics = instrumentation.render()
+    assert 'sql_statement_seconds_count{statement="SELECT"} 2' in metrics
+    assert 'http_request_sql_statements_sum{endpoint="allocate"} 2' in metrics
+    assert 'http_request_seconds_count{endpoint="allocate"} 1' in metrics
+
+
+def test_statements_on_an_attached_thread_count_towards_the_request(instrumented):
+    engine = create_engine("sqlite:///:memory:")
+    instrumentation.instrument_engine(engine)
+    instrumentation.start_request()
+    request = instrumentation.current_request()
+
+    def worker():
+        with instrumentation.attach_request(request):
+            engine.execute("SELECT 1")
+        engine.execute("SELECT 2")
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    instrumentation.end_request("allocate")
+
+    metrics = instrumentation.render()
+    assert 'http_request_sql_statements_sum{endpoint="allocate"} 1' in metrics
+
+
+def test_ending_a_request_that_was_not_started_records_nothing(instrumented):
+    assert instrumentation.end_request("allocate") is None
+    assert "http_request_seconds_count" not in instrumentation.render()
+
+
+def test_sampled_requests_dump_a_profile(instrumented, monkeypatch, tmp_path):
+    monkeypatch.setattr(instrumentation, "profile_sample_rate", 1.0)
+    monkeypatch.setattr(instrumentation, "profile_dir", str(tmp_path))
+
+    instrumentation.start_request()
+    path = instrumentation.end_request("allocate")
+
+    assert path.startswith(str(tmp_path)) and path.endswith(".prof")
+    assert (tmp_path / path.split("/")[-1]).stat().st_size > 0
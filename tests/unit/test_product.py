@@ -41,3 +41,237 @@ def test_cannot_deallocate_unallocated_line():
     assert product.batches[0].available_quantity == 20
     product.deallocate("order1", sku)
     assert product.batches[0].available_quantity == 20
+
+
+def test_allocate_prefers_in_stock_batches_then_earliest_eta():
+    sku = random_sku()
+    product = Product(sku, batches=[])
+    product.add_batch(Batch("later", sku, 100, eta=later))
+    product.add_batch(Batch("in-stock", sku, 100, eta=None))
+    product.add_batch(Batch("today", sku, 100, eta=today))
+
+    assert product.allocate(OrderLine("o1", sku, 10)) == "in-stock"
+
+
+def test_allocate_skips_batches_without_enough_available_quantity():
+    sku = random_sku()
+    product = Product(
+        sku,
+        batches=[
+            Batch("in-stock", sku, 5, eta=None),
+            Batch("today", sku, 20, eta=today),
+            Batch("tomorrow", sku, 100, eta=tomorrow),
+        ],
+    )
+
+    assert product.allocate(OrderLine("o1", sku, 10)) == "today"
+    assert product.allocate(OrderLine("o2", sku, 10)) == "today"
+    assert product.allocate(OrderLine("o3", sku, 10)) == "tomorrow"
+    assert product.allocate(OrderLine("o4", sku, 5)) == "in-stock"
+
+
+def test_allocate_uses_batches_freed_by_deallocate():
+    sku = random_sku()
+    product = Product(
+        sku,
+        batches=[
+            Batch("today", sku, 10, eta=today),
+            Batch("later", sku, 10, eta=later),
+        ],
+    )
+    product.allocate(OrderLine("o1", sku, 10))
+    assert product.allocate(OrderLine("o2", sku, 10)) == "later"
+
+    product.deallocate("o1", sku)
+
+    assert product.allocate(OrderLine("o3", sku, 10)) == "today"
+
+
+def test_allocate_chooses_same_batch_as_sorting_all_batches():
+    sku = random_sku()
+    etas = [None, today, tomorrow, later]
+    product = Product(sku, batches=[])
+    for i in range(40):
+        product.add_batch(Batch(f"batch{i}", sku, (i * 7) % 23 + 1, eta=etas[i % 4]))
+
+    for i in range(200):
+        line = OrderLine(f"order{i}", sku, i % 9 + 1)
+        expected = next(
+            (b for b in sorted(product.batches) if b.can_allocate(line)), None
+        )
+        if expected is None:
+            with pytest.raises(OutOfStock):
+                product.allocate(line)
+        else:
+            assert product.allocate(line) == expected.batch_ref
+
+
+def test_deallocate_frees_the_batch_the_order_was_allocated_to():
+    sku = random_sku()
+    product = Product(
+        sku,
+        batches=[
+            Batch("today", sku, 10, eta=today),
+            Batch("later", sku, 10, eta=later),
+        ],
+    )
+    product.allocate(OrderLine("o1", sku, 10))
+    product.allocate(OrderLine("o2", sku, 4))
+
+    product.deallocate("o2", sku)
+
+    assert [b.available_quantity for b in product.batches] == [0, 10]
+
+
+def test_deallocate_ignores_other_skus():
+    sku = random_sku()
+    product = Product(sku, batches=[Batch("batch1", sku, 10, eta=today)])
+    product.allocate(OrderLine("o1", sku, 10))
+
+    product.deallocate("o1", "OTHER-SKU")
+
+    assert product.batches[0].available_quantity == 0
+
+
+def test_can_reallocate_and_deallocate_the_same_order():
+    sku = random_sku()
+    product = Product(sku, batches=[Batch("batch1", sku, 10, eta=today)])
+
+    for _ in range(3):
+        product.allocate(OrderLine("o1", sku, 10))
+        product.deallocate("o1", sku)
+
+    assert product.batches[0].available_quantity == 10
+    assert product.batches[0].orderids == set()
+
+
+def test_deallocate_finds_orders_in_batches_added_with_allocations():
+    sku = random_sku()
+    product = Product(sku, batches=[Batch("batch1", sku, 10, eta=today)])
+    product.deallocate("o1", sku)
+    batch = Batch("batch2", sku, 10, eta=None)
+    batch.allocate(OrderLine("o1", sku, 10))
+
+    product.add_batch(batch)
+    product.deallocate("o1", sku)
+
+    assert batch.available_quantity == 10
+
+
+def test_deallocate_order_split_across_batches():
+    sku = random_sku()
+    product = Product(
+        sku,
+        batches=[
+            Batch("today", sku, 10, eta=today),
+            Batch("later", sku, 10, eta=later),
+        ],
+    )
+    product.deallocate("nothing-yet", sku)
+    product.allocate(OrderLine("o1", sku, 8))
+    product.allocate(OrderLine("o1", sku, 7))
+
+    product.deallocate("o1", sku)
+    product.deallocate("o1", sku)
+    product.deallocate("o1", sku)
+
+    assert [b.available_quantity for b in product.batches] == [10, 10]
+
+
+def test_allocate_sees_stock_taken_outside_the_product():
+    sku = random_sku()
+    product = Product(sku, batches=[Batch("batch1", sku, 10, eta=None)])
+    product.allocate(OrderLine("o1", sku, 1))
+    product.batches[0].allocate(OrderLine("elsewhere", sku, 7))
+
+    with pytest.raises(OutOfStock):
+        product.allocate(OrderLine("o2", sku, 5))
+    assert product.batches[0].available_quantity == 2
+    assert product.version_number == 1
+
+
+def test_allocate_sees_a_batch_swapped_for_another():
+    sku = random_sku()
+    product = Product(sku, batches=[Batch("batch1", sku, 10, eta=None)])
+    product.allocate(OrderLine("o1", sku, 1))
+    product.batches[0] = Batch("batch2", sku, 1, eta=None)
+
+    with pytest.raises(OutOfStock):
+        product.allocate(OrderLine("o2", sku, 5))
+    assert product.allocate(OrderLine("o3", sku, 1)) == "batch2"
+
+
+def test_allocate_many_sees_stock_taken_outside_the_product():
+    sku = random_sku()
+    product = Product(
+        sku,
+        batches=[Batch("batch1", sku, 10, eta=None), Batch("batch2", sku, 10, later)],
+    )
+    product.allocate(OrderLine("o1", sku, 1))
+    product.batches[0].allocate(OrderLine("elsewhere", sku, 7))
+
+    results = product.allocate_many([OrderLine("o2", sku, 5), OrderLine("o3", sku, 2)])
+
+    assert results == ["batch2", "batch1"]
+    assert [b.available_quantity for b in product.batches] == [0, 5]
+
+
+def _product_with_mixed_batches(sku):
+    etas = [None, today, tomorrow, later]
+    product = Product(sku, batches=[])
+    for i in range(40):
+        product.add_batch(Batch(f"batch{i}", sku, (i * 7) % 23 + 1, eta=etas[i % 4]))
+    return product
+
+
+def test_allocate_many_matches_allocating_each_line_in_turn():
+    sku = random_sku()
+    wave = [OrderLine(f"order{i % 150}", sku, i % 9 + 1) for i in range(200)]
+    wave += [OrderLine("other", random_sku(), 1), wave[3], wave[3]]
+    sequential = _product_with_mixed_batches(sku)
+    expected = []
+    for line in wave:
+        try:
+            expected.append(sequential.allocate(line))
+        except OutOfStock:
+            expected.append(None)
+
+    product = _product_with_mixed_batches(sku)
+    results = product.allocate_many(wave)
+
+    assert [r if isinstance(r, str) else None for r in results] == expected
+    assert [b.available_quantity for b in product.batches] == [
+        b.available_quantity for b in sequential.batches
+    ]
+    assert product.version_number == sequential.version_number
+
+
+def test_allocate_many_returns_out_of_stock_for_lines_that_dont_fit():
+    sku = random_sku()
+    product = Product(sku, batches=[Batch("batch1", sku, 10, eta=None)])
+
+    results = product.allocate_many(
+        [OrderLine("o1", sku, 8), OrderLine("o2", sku, 5), OrderLine("o3", sku, 2)]
+    )
+
+    assert results[0] == "batch1"
+    assert isinstance(results[1], OutOfStock)
+    assert results[2] == "batch1"
+    assert product.version_number == 2
+
+
+def test_allocate_many_leaves_the_product_ready_for_deallocate_and_allocate():
+    sku = random_sku()
+    product = Product(
+        sku,
+        batches=[
+            Batch("in-stock", sku, 10, eta=None),
+            Batch("later", sku, 10, eta=later),
+        ],
+    )
+    product.deallocate("nothing-yet", sku)
+
+    product.allocate_many([OrderLine("o1", sku, 10), OrderLine("o2", sku, 5)])
+    product.deallocate("o1", sku)
+
+    assert product.allocate(OrderLine("o3", sku, 10)) == "in-stock"
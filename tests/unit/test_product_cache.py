@@ -0,0 +1,49 @@
+from app.adapters.product_cache import ProductCache
+from app.domain.model import Product
+
+
+def test_checkout_returns_product_at_current_version():
+    cache = ProductCache(max_size=2)
+    product = Product("LAMP", batches=[], version_number=3)
+    cache.put(product)
+
+    assert cache.checkout("LAMP", 3) is product
+    assert cache.snapshot()["hits"] == 1
+
+
+def test_checkout_hands_a_product_to_one_caller_at_a_time():
+    cache = ProductCache(max_size=2)
+    cache.put(Product("LAMP", batches=[], version_number=3))
+
+    assert cache.checkout("LAMP", 3) is not None
+    assert cache.checkout("LAMP", 3) is None
+
+
+def test_checkout_drops_product_at_older_version():
+    cache = ProductCache(max_size=2)
+    cache.put(Product("LAMP", batches=[], version_number=3))
+
+    assert cache.checkout("LAMP", 4) is None
+    assert len(cache) == 0
+    assert cache.snapshot()["stale"] == 1
+    assert cache.snapshot()["misses"] == 1
+
+
+def test_evicts_least_recently_used_products():
+    cache = ProductCache(max_size=2)
+    for sku in ["LAMP", "CHAIR", "LAMP", "TABLE"]:
+        cache.put(Product(sku, batches=[], version_number=1))
+
+    assert cache.checkout("CHAIR", 1) is None
+    assert cache.checkout("LAMP", 1) is not None
+    assert cache.checkout("TABLE", 1) is not None
+    assert cache.snapshot()["evictions"] == 1
+
+
+def test_invalidate_removes_product():
+    cache = ProductCache(max_size=2)
+    cache.put(Product("LAMP", batches=[], version_number=1))
+
+    cache.invalidate("LAMP")
+
+    assert cache.checkout("LAMP", 1) is None
@@ -1,11 +1,12 @@
 import pytest
-from typing import List
+from typing import List, Optional
 from datetime import date, timedelta
 from tests.helpers import random_sku, random_batchref, random_orderid
 from app.domain import model
 
+from app.adapters.idempotency_repository import AbstractIdempotencyKeyRepository
 from app.adapters.product_repository import AbstractProductRepository
-from app.service_layer import services
+from app.service_layer import services, retries
 from app.adapters import unit_of_work
 
 today = date.today()
@@ -24,9 +25,21 @@ class FakeProductRepository(AbstractProductRepository):
         return next((p for p in self.products if p.sku == sku), None)
 
 
+class FakeIdempotencyKeyRepository(AbstractIdempotencyKeyRepository):
+    def __init__(self):
+        self.batchrefs = {}
+
+    def add(self, key: str, batchref: str):
+        self.batchrefs[key] = batchref
+
+    def get(self, key: str) -> Optional[str]:
+        return self.batchrefs.get(key)
+
+
 class FakeUnitOfWork2(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
         self.products = FakeProductRepository()
+        self.idempotency_keys = FakeIdempotencyKeyRepository()
         self.committed = False
 
     def commit(self):
@@ -116,3 +129,157 @@ def test_deallocate():
 
     services.deallocate(orderid=orderid1, sku=sku, uow=uow)
     services.allocate(orderid=orderid2, sku=sku, qty=10, uow=uow)
+
+
+class ConflictingUnitOfWork(FakeUnitOfWork2):
+    def __init__(self, conflicts: int):
+        super().__init__()
+        self.conflicts = conflicts
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+        if self.commits <= self.conflicts:
+            raise unit_of_work.ConcurrencyError("version conflict")
+        super().commit()
+
+
+no_backoff = retries.RetryPolicy(attempts=3, base_delay=0, max_delay=0)
+
+
+def test_allocate_retries_after_concurrency_conflict():
+    sku = random_sku()
+    uow = ConflictingUnitOfWork(conflicts=0)
+    services.add_batch("b1", sku, 100, eta=None, uow=uow)
+    uow.conflicts, uow.commits = 2, 0
+    retries.stats.reset()
+
+    batchref = services.allocate("o1", sku, 10, uow=uow, retry_policy=no_backoff)
+
+    assert batchref == "b1"
+    assert uow.committed
+    assert retries.stats.snapshot() == {"conflicts": 2, "retries": 2, "exhausted": 0}
+
+
+def test_gives_up_after_retry_policy_attempts():
+    uow = ConflictingUnitOfWork(conflicts=5)
+    retries.stats.reset()
+
+    with pytest.raises(unit_of_work.ConcurrencyError):
+        services.add_batch(
+            "b1", random_sku(), 100, eta=None, uow=uow, retry_policy=no_backoff
+        )
+
+    assert uow.commits == 3
+    assert retries.stats.snapshot() == {"conflicts": 3, "retries": 2, "exhausted": 1}
+
+
+def test_backoff_is_jittered_below_capped_exponential():
+    policy = retries.RetryPolicy(attempts=10, base_delay=0.01, max_delay=0.05)
+
+    assert all(0 <= policy.backoff(1) <= 0.01 for _ in range(100))
+    assert all(0 <= policy.backoff(8) <= 0.05 for _ in range(100))
+
+
+class CountingProductRepository(FakeProductRepository):
+    def __init__(self, products: List[model.Product] = []):
+        super().__init__(products)
+        self.gets = []
+
+    def get(self, sku: str) -> model.Product:
+        self.gets.append(sku)
+        return super().get(sku)
+
+
+def test_allocate_many_returns_result_for_each_line():
+    sku1, sku2 = random_sku(), random_sku()
+    uow = FakeUnitOfWork2()
+    services.add_batch("b1", sku1, 10, eta=None, uow=uow)
+    services.add_batch("b2", sku2, 10, eta=None, uow=uow)
+
+    results = services.allocate_many(
+        [("o1", sku1, 6), ("o1", sku2, 6), ("o2", sku1, 6), ("o3", "NO-SKU", 1)],
+        uow=uow,
+    )
+
+    assert results == [
+        services.AllocationResult("o1", sku1, 6, batchref="b1"),
+        services.AllocationResult("o1", sku2, 6, batchref="b2"),
+        services.AllocationResult("o2", sku1, 6, error=f"Out of stock for sku: {sku1}"),
+        services.AllocationResult("o3", "NO-SKU", 1, error="Invalid sku: NO-SKU"),
+    ]
+
+
+def test_allocate_many_loads_each_product_once_and_commits_once():
+    sku1, sku2 = random_sku(), random_sku()
+    uow = ConflictingUnitOfWork(conflicts=0)
+    services.add_batch("b1", sku1, 100, eta=None, uow=uow)
+    services.add_batch("b2", sku2, 100, eta=None, uow=uow)
+    uow.products = CountingProductRepository(uow.products.products)
+    uow.commits = 0
+
+    services.allocate_many(
+        [(f"o{i}", sku1 if i % 2 else sku2, 1) for i in range(20)], uow=uow
+    )
+
+    assert sorted(uow.products.gets) == sorted([sku1, sku2])
+    assert uow.commits == 1
+
+
+def test_allocate_order_loads_products_in_sku_order_and_commits_once():
+    sku1, sku2 = sorted([random_sku(), random_sku()])
+    uow = ConflictingUnitOfWork(conflicts=0)
+    services.add_batch("b1", sku1, 100, eta=None, uow=uow)
+    services.add_batch("b2", sku2, 100, eta=None, uow=uow)
+    uow.products = CountingProductRepository(uow.products.products)
+    uow.commits = 0
+
+    batch_refs = services.allocate_order(
+        "o1", [(sku2, 10), (sku1, 10), (sku2, 5)], uow=uow
+    )
+
+    assert batch_refs == ["b2", "b1", "b2"]
+    assert uow.products.gets == [sku1, sku2]
+    assert uow.commits == 1
+
+
+def test_allocate_order_commits_nothing_if_a_line_is_out_of_stock():
+    sku1, sku2 = random_sku(), random_sku()
+    uow = FakeUnitOfWork2()
+    services.add_batch("b1", sku1, 100, eta=None, uow=uow)
+    services.add_batch("b2", sku2, 5, eta=None, uow=uow)
+    uow.committed = False
+
+    with pytest.raises(model.OutOfStock, match=sku2):
+        services.allocate_order("o1", [(sku1, 10), (sku2, 10)], uow=uow)
+
+    assert not uow.committed
+
+
+def test_allocate_order_with_an_unknown_sku_allocates_nothing():
+    sku = random_sku()
+    uow = FakeUnitOfWork2()
+    services.add_batch("b1", sku, 100, eta=None, uow=uow)
+    uow.committed = False
+
+    with pytest.raises(services.InvalidSku, match="NO-SKU"):
+        services.allocate_order("o1", [(sku, 10), ("NO-SKU", 1)], uow=uow)
+
+    assert uow.products.get(sku).batches[0].available_quantity == 100
+    assert not uow.committed
+
+
+def test_allocate_with_repeated_idempotency_key_returns_first_result():
+    sku = random_sku()
+    uow = ConflictingUnitOfWork(conflicts=0)
+    services.add_batch("b1", sku, 100, eta=None, uow=uow)
+    services.add_batch("b2", sku, 100, eta=tomorrow, uow=uow)
+    uow.products = CountingProductRepository(uow.products.products)
+    uow.commits = 0
+
+    first = services.allocate("o1", sku, 100, uow=uow, idempotency_key="k1")
+    retried = services.allocate("o1", sku, 100, uow=uow, idempotency_key="k1")
+
+    assert first == retried == "b1"
+    assert uow.products.gets == [sku]
+    assert uow.commits == 1